@@ -0,0 +1,155 @@
+"""
+Compares the plans and timings of the old and the rewritten catalog queries
+of retrieve_book and retrieve_purchased on a large seeded dataset.
+
+The old retrieve_purchased made two round trips; OLD_PURCHASED folds them
+into one statement, so its timing does not include the second round trip.
+The dataset is created inside a transaction that is rolled back at the end,
+so run it against a local database:
+
+    python benchmarks/catalog_queries.py --users 20000 --books 200000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+from config import get_connection
+from controllers import book
+
+SEED = """
+SELECT setseed(0.42);
+
+INSERT INTO public.user (name, email, password)
+SELECT 'reader ' || n, 'reader' || n || '@bench.local', ''::bytea
+FROM generate_series(1, %(users)s) AS n;
+
+CREATE TEMPORARY TABLE bench_user ON COMMIT DROP AS
+SELECT row_number() OVER () AS n, id FROM public.user WHERE email LIKE '%%@bench.local';
+
+INSERT INTO public.book (name, file_path, price, author_id, royalty, is_active)
+SELECT 'book ' || book.n, '/books/' || book.n || '.pdf', (book.n %% 50) + 0.99,
+    bench_user.id, 10, book.n %% 10 <> 0
+FROM (
+    SELECT n, 1 + floor(random() * %(users)s / 10) AS author_n
+    FROM generate_series(1, %(books)s) AS n
+) AS book
+LEFT JOIN bench_user ON bench_user.n = book.author_n AND book.n %% 20 <> 0;
+
+CREATE TEMPORARY TABLE bench_book ON COMMIT DROP AS
+SELECT row_number() OVER () AS n, id FROM public.book WHERE name LIKE 'book %%';
+
+INSERT INTO public.transactions (user_id, book_id, amount, time)
+SELECT bench_user.id, bench_book.id, 9.99, now()
+FROM (
+    SELECT 1 + floor(random() * %(users)s) AS user_n,
+        1 + floor(random() * %(books)s) AS book_n
+    FROM generate_series(1, %(purchases)s)
+) AS purchase
+JOIN bench_user ON bench_user.n = purchase.user_n
+JOIN bench_book ON bench_book.n = purchase.book_n;
+
+INSERT INTO public.reading (book_id, user_id)
+SELECT DISTINCT book_id, user_id FROM public.transactions WHERE random() < 0.3
+ON CONFLICT DO NOTHING;
+
+ANALYZE public.user, public.book, public.transactions, public.reading;
+"""
+
+OLD_CATALOG = """SELECT * FROM (
+    SELECT id,name,author_id,price,file_path FROM public.book
+    WHERE id IN (
+        SELECT book_id FROM public.transactions WHERE user_id = %(user_id)s
+    ) OR author_id = %(user_id)s
+    UNION
+    SELECT id, name, author_id, price, NULL AS file_path
+    FROM public.book
+    WHERE ((id NOT IN (
+        SELECT book_id FROM public.transactions WHERE user_id = %(user_id)s
+    ) AND author_id != %(user_id)s AND is_active = True) OR author_id IS NULL)
+    ) AS catalog WHERE id > 0 ORDER BY id LIMIT %(limit)s"""
+
+OLD_PURCHASED = """SELECT id,name,author_id,price,file_path FROM public.book WHERE
+    id = ANY(ARRAY(
+        SELECT book_id FROM public.transactions WHERE user_id = %(user_id)s
+        EXCEPT SELECT book_id FROM public.reading WHERE user_id = %(user_id)s
+    )) ORDER BY id LIMIT %(limit)s"""
+
+# name, old query, the query the controller runs, and the parameters of the
+# latter for the first page of user_id
+QUERIES = [
+    (
+        "retrieve_book (catalog)",
+        OLD_CATALOG,
+        book.USER_CATALOG,
+        lambda user_id, limit: (user_id, user_id, user_id, 0, limit),
+    ),
+    (
+        "retrieve_purchased",
+        OLD_PURCHASED,
+        book.PURCHASED,
+        lambda user_id, limit: (user_id, user_id, 0, limit),
+    ),
+]
+
+
+def timed(cursor, query, params, repeat):
+    """Returns the rows of query and its best wall clock time in ms"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best
+
+
+def explain(cursor, query, params):
+    """Returns the EXPLAIN ANALYZE output of query"""
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+    return "\n".join(row[0] for row in cursor.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--books", type=int, default=200000)
+    parser.add_argument("--purchases", type=int, default=1000000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--plans", action="store_true", help="print query plans")
+    args = parser.parse_args()
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        start = time.perf_counter()
+        cursor.execute(SEED, vars(args))
+        print(f"seeded in {time.perf_counter() - start:.1f}s")
+
+        cursor.execute(
+            """SELECT user_id FROM public.transactions GROUP BY user_id
+            ORDER BY count(*) DESC LIMIT 1"""
+        )
+        params = {"user_id": cursor.fetchone()[0], "limit": args.limit}
+
+        for name, old, new, new_params in QUERIES:
+            new_params = new_params(params["user_id"], params["limit"])
+            old_rows, old_ms = timed(cursor, old, params, args.repeat)
+            new_rows, new_ms = timed(cursor, new, new_params, args.repeat)
+            same = sorted(set(old_rows)) == sorted(set(new_rows))
+            print(
+                f"{name}: old {old_ms:.1f} ms, new {new_ms:.1f} ms, same rows: {same}"
+            )
+            if args.plans:
+                print("-- old plan\n" + explain(cursor, old, params))
+                print("-- new plan\n" + explain(cursor, new, new_params))
+
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
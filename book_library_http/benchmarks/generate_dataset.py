@@ -0,0 +1,326 @@
+"""
+Generates a large synthetic dataset for scale testing and loads it with COPY.
+
+    python benchmarks/generate_dataset.py --users 1000000 --books 200000
+
+The shape follows a real store: the first --author-share of the users write
+books, and how many books each writes follows a Zipf law, so a few authors
+have huge catalogs. Book popularity is Zipfian too. Purchases per user are
+heavy tailed, and a share of purchases is being read and a share of those
+is completed. Some users hold a valid login token.
+
+The same --seed and sizes always give the same rows; only token expiry
+depends on when the generator runs. Ids continue after the rows already in
+the tables. Every user's password is --password, hashed once up front, so
+the generator is not bound by bcrypt.
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sys
+import time
+import uuid
+from array import array
+
+import bcrypt
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+from config import BCRYPT_ROUNDS, get_connection
+
+TABLES = ("user", "book", "transactions", "reading", "user_token")
+PRICES = (0.99, 2.99, 4.99, 7.99, 9.99, 14.99, 19.99, 29.99)
+EPOCH = datetime.datetime(2024, 1, 1)
+
+# the purchase endpoints keep book_earnings up to date; copied purchases are
+# added to it in one go
+ROLL_UP_EARNINGS = """
+INSERT INTO public.book_earnings AS earnings
+    (book_id, period, author_id, units, gross, royalty)
+SELECT transactions.book_id, date_trunc('month', transactions.time)::date,
+    book.author_id, count(*), sum(transactions.amount),
+    sum(transactions.amount * COALESCE(book.royalty, 0) / 100)
+FROM public.transactions
+JOIN public.book ON book.id = transactions.book_id
+WHERE transactions.id > %s
+GROUP BY 1, 2, 3
+ON CONFLICT (book_id, period) DO UPDATE SET
+    units = earnings.units + EXCLUDED.units,
+    gross = earnings.gross + EXCLUDED.gross,
+    royalty = earnings.royalty + EXCLUDED.royalty
+"""
+# copied readers are added to the totals of book_engagement; its daily
+# counts are left to live traffic
+COUNT_READERS = """
+INSERT INTO public.book_engagement AS engagement (book_id, started, completed)
+SELECT book_id, count(*), count(*) FILTER (WHERE is_completed)
+FROM public.reading
+WHERE id > %s
+GROUP BY book_id
+ON CONFLICT (book_id) DO UPDATE SET
+    started = engagement.started + EXCLUDED.started,
+    completed = engagement.completed + EXCLUDED.completed
+"""
+
+
+class RowStream:
+    """
+    File like object that COPY reads rows from, producing them as it goes
+    so that the whole table is never held in memory
+    """
+
+    def __init__(self, rows):
+        self._lines = ("\t".join(row) + "\n" for row in rows)
+        self._buffer = ""
+        self.count = 0
+
+    def read(self, size=-1):
+        size = 1 << 16 if size is None or size < 0 else size
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+            if length >= size:
+                break
+        data = "".join(chunks)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def zipf_weights(count, exponent):
+    """Returns cumulative Zipf weights of ranks 1 to count"""
+    return list(
+        itertools.accumulate(1 / rank**exponent for rank in range(1, count + 1))
+    )
+
+
+def first_ids(cursor):
+    """Returns the id that generated rows of each table start after"""
+    ids = {}
+    for table in ("user", "book", "transactions", "reading"):
+        cursor.execute(f"SELECT COALESCE(max(id), 0) FROM public.{table}")
+        ids[table] = cursor.fetchone()[0]
+    return ids
+
+
+class Dataset:
+    """The rows of every table, generated from one seed"""
+
+    def __init__(self, args, ids, password_hash):
+        self.args = args
+        self.ids = ids
+        self.password = "\\\\x" + password_hash.hex()
+        self.authors = max(1, int(args.users * args.author_share))
+
+        rng = random.Random(args.seed)
+        # the author of every book, as an index into the users or -1
+        author_weights = zipf_weights(self.authors, args.author_exponent)
+        self.book_author = array(
+            "i",
+            (
+                -1 if rng.random() < args.authorless_share else author
+                for author in rng.choices(
+                    range(self.authors), cum_weights=author_weights, k=args.books
+                )
+            ),
+        )
+        # book indexes from the most to the least popular
+        self.by_popularity = array("i", range(args.books))
+        rng.shuffle(self.by_popularity)
+        self.popularity = zipf_weights(args.books, args.popularity_exponent)
+        self.book_price = [rng.choice(PRICES) for _ in range(args.books)]
+
+    def user_id(self, index):
+        return self.ids["user"] + 1 + index
+
+    def book_id(self, index):
+        return self.ids["book"] + 1 + index
+
+    def users(self):
+        for index in range(self.args.users):
+            user_id = self.user_id(index)
+            yield (
+                str(user_id),
+                f"reader {user_id}",
+                f"reader{user_id}@dataset.test",
+                self.password,
+                "\\N",
+                "\\N",
+                "t",
+                "f",
+            )
+
+    def books(self):
+        rng = random.Random(f"{self.args.seed}-books")
+        for index, author in enumerate(self.book_author):
+            book_id = self.book_id(index)
+            yield (
+                str(book_id),
+                f"book {book_id}",
+                f"/books/{book_id}.pdf",
+                str(self.book_price[index]),
+                "\\N" if author < 0 else str(self.user_id(author)),
+                str(rng.randrange(5, 31)),
+                "f" if rng.random() < self.args.inactive_share else "t",
+            )
+
+    def purchases(self, index):
+        """
+        Returns the books bought by the user with index, the same on every
+        call, as (book index, seconds after EPOCH, reading state) where the
+        reading state is None, False or True for completed
+        """
+        rng = random.Random(f"{self.args.seed}-user-{index}")
+        count = min(
+            self.args.books,
+            int(rng.paretovariate(self.args.purchase_tail) * self.args.min_purchases),
+        )
+        ranks = rng.choices(
+            range(self.args.books), cum_weights=self.popularity, k=count
+        )
+        bought = []
+        seen = set()
+        for rank in ranks:
+            book = self.by_popularity[rank]
+            if book in seen or self.book_author[book] == index:
+                continue
+            seen.add(book)
+            state = None
+            if rng.random() < self.args.reading_share:
+                state = rng.random() < self.args.completion_share
+            bought.append((book, rng.randrange(self.args.days * 86400), state))
+        return bought
+
+    def transactions(self):
+        transaction_id = self.ids["transactions"]
+        for index in range(self.args.users):
+            user_id = str(self.user_id(index))
+            for book, seconds, _ in self.purchases(index):
+                transaction_id += 1
+                moment = EPOCH + datetime.timedelta(seconds=seconds)
+                yield (
+                    user_id,
+                    str(self.book_id(book)),
+                    str(self.book_price[book]),
+                    moment.isoformat(sep=" "),
+                    str(transaction_id),
+                )
+
+    def readings(self):
+        reading_id = self.ids["reading"]
+        for index in range(self.args.users):
+            user_id = str(self.user_id(index))
+            for book, _, state in self.purchases(index):
+                if state is None:
+                    continue
+                reading_id += 1
+                yield (
+                    str(self.book_id(book)),
+                    user_id,
+                    str(reading_id),
+                    "t" if state else "f",
+                )
+
+    def tokens(self):
+        rng = random.Random(f"{self.args.seed}-tokens")
+        expires = (datetime.datetime.now() + datetime.timedelta(days=1)).isoformat(
+            sep=" "
+        )
+        for index in range(self.args.users):
+            if rng.random() < self.args.token_share:
+                token = uuid.UUID(int=rng.getrandbits(128), version=4)
+                yield (str(self.user_id(index)), str(token), expires)
+
+
+COPIES = (
+    (
+        "users",
+        "public.user (id, name, email, password, bank_account, upi_id, "
+        "is_active, is_admin)",
+    ),
+    (
+        "books",
+        "public.book (id, name, file_path, price, author_id, royalty, is_active)",
+    ),
+    ("transactions", "public.transactions (user_id, book_id, amount, time, id)"),
+    ("readings", "public.reading (book_id, user_id, id, is_completed)"),
+    ("tokens", "public.user_token (user_id, token, expiration_time)"),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--books", type=int, default=100000)
+    parser.add_argument("--author-share", type=float, default=0.02)
+    parser.add_argument("--author-exponent", type=float, default=1.2)
+    parser.add_argument("--authorless-share", type=float, default=0.02)
+    parser.add_argument("--inactive-share", type=float, default=0.05)
+    parser.add_argument("--popularity-exponent", type=float, default=1.0)
+    parser.add_argument("--min-purchases", type=int, default=3)
+    parser.add_argument("--purchase-tail", type=float, default=1.5)
+    parser.add_argument("--reading-share", type=float, default=0.6)
+    parser.add_argument("--completion-share", type=float, default=0.35)
+    parser.add_argument("--token-share", type=float, default=0.1)
+    parser.add_argument("--days", type=int, default=365, help="purchase history")
+    parser.add_argument("--password", default="password")
+    args = parser.parse_args()
+
+    password_hash = bcrypt.hashpw(
+        args.password.encode("utf-8"), bcrypt.gensalt(BCRYPT_ROUNDS)
+    )
+
+    start = time.perf_counter()
+    total = 0
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        dataset = Dataset(args, first_ids(cursor), password_hash)
+        print(f"prepared in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        for rows, table in COPIES:
+            started = time.perf_counter()
+            stream = RowStream(getattr(dataset, rows)())
+            cursor.copy_expert(f"COPY {table} FROM STDIN", stream)
+            elapsed = time.perf_counter() - started
+            total += stream.count
+            print(
+                f"{rows}: {stream.count} rows in {elapsed:.1f}s "
+                f"({stream.count / elapsed * 60:,.0f} rows/min)",
+                file=sys.stderr,
+            )
+
+        for rollup, table, first_id in (
+            (ROLL_UP_EARNINGS, "book_earnings", dataset.ids["transactions"]),
+            (COUNT_READERS, "book_engagement", dataset.ids["reading"]),
+        ):
+            started = time.perf_counter()
+            cursor.execute(rollup, (first_id,))
+            print(
+                f"{table}: {cursor.rowcount} rows in "
+                f"{time.perf_counter() - started:.1f}s",
+                file=sys.stderr,
+            )
+
+        for table in TABLES[:4]:
+            cursor.execute(
+                f"""SELECT setval(pg_get_serial_sequence('public.{table}', 'id'),
+                (SELECT max(id) FROM public.{table}))"""
+            )
+        conn.commit()
+
+        conn.autocommit = True
+        rollups = "public.book_earnings, public.book_engagement"
+        cursor.execute(f"ANALYZE {', '.join('public.' + t for t in TABLES)}, {rollups}")
+
+    elapsed = time.perf_counter() - start
+    print(f"{total} rows in {elapsed:.1f}s ({total / elapsed * 60:,.0f} rows/min)")
+
+
+if __name__ == "__main__":
+    main()
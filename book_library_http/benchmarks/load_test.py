@@ -0,0 +1,438 @@
+"""
+End to end load test of manage.py over HTTP.
+
+Starts the server, signs up and logs in synthetic users, has an author
+publish books and then drives a mix of catalog reads, purchases, readings
+and completions. Prints throughput, latency percentiles and error rates per
+route as JSON.
+
+    python benchmarks/load_test.py --users 200 --duration 30
+    python benchmarks/load_test.py --mode open --rate 500 --output run.json
+    python benchmarks/load_test.py --ephemeral      # throwaway Postgres
+
+Closed loop runs --concurrency clients that send their next request as soon
+as the previous one is answered. Open loop sends --rate requests per second
+whatever the latency, and measures each request from the moment it was due,
+so a slow server is not hidden by clients that back off. Without
+--ephemeral the server uses the database of the DB_* variables, which the
+test writes to; use a scratch database.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+DEFAULT_MIX = "book=70,purchase=10,reading=10,completed=10"
+
+
+def free_port():
+    """Returns a TCP port that nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout, process=None):
+    """Waits until something accepts connections on port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("server exited during start up")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing is listening on port {port}")
+
+
+class EphemeralPostgres:
+    """
+    Throwaway Postgres cluster in a temporary directory, made with the
+    initdb and pg_ctl found in --pg-bin or on PATH
+    """
+
+    def __init__(self, pg_bin=None):
+        self.pg_bin = pg_bin
+        self.directory = tempfile.mkdtemp(prefix="load-test-pg-")
+        self.port = free_port()
+
+    def _tool(self, name):
+        path = os.path.join(self.pg_bin, name) if self.pg_bin else shutil.which(name)
+        if not path:
+            raise RuntimeError(f"{name} not found, pass --pg-bin")
+        return path
+
+    def start(self):
+        data = os.path.join(self.directory, "data")
+        subprocess.run(
+            [self._tool("initdb"), "-D", data, "-U", "postgres", "-A", "trust"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        options = f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1"
+        subprocess.run(
+            [self._tool("pg_ctl"), "-D", data, "-o", options, "-w", "start"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        return {
+            "DB_NAME": "postgres",
+            "DB_USER": "postgres",
+            "DB_PASSWORD": "",
+            "DB_HOST": "127.0.0.1",
+            "DB_PORT": str(self.port),
+        }
+
+    def stop(self):
+        data = os.path.join(self.directory, "data")
+        subprocess.run(
+            [self._tool("pg_ctl"), "-D", data, "-m", "fast", "stop"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Client:
+    """Keep-alive HTTP connection to the server"""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    def request(self, method, path, body=None, token=None, content_type=None):
+        """Returns the status, body and headers of the response"""
+        headers = {}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body)
+            content_type = content_type or "application/json"
+        if content_type:
+            headers["Content-Type"] = content_type
+
+        for attempt in range(2):
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                return response.status, response.read(), response.headers
+
+            except (http.client.HTTPException, OSError):
+                # the server closed an idle or exhausted connection
+                self.conn.close()
+                self.conn = http.client.HTTPConnection(
+                    "127.0.0.1", self.port, timeout=30
+                )
+                if attempt:
+                    raise
+
+
+class Reader:
+    """
+    Synthetic user, and the books it may still buy, read and complete
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.to_buy = []
+        self.to_read = []
+        self.to_complete = []
+
+
+def login(client, email):
+    """Signs up email and returns its token"""
+    user = {"name": email.split("@")[0], "email": email, "password": "load-test"}
+    client.request("POST", "/signup", user)
+    status, body, _ = client.request(
+        "POST", "/login", {"email": email, "password": "load-test"}
+    )
+    if status != 200:
+        raise RuntimeError(f"login failed: {status} {body[:200]}")
+    return json.loads(body)["token"]
+
+
+def setup(port, args):
+    """
+    Signs up and logs in the users, and has a separate author publish the
+    books. Returns the readers.
+    """
+    client = Client(port)
+    run = f"{int(time.time())}{random.randrange(1000):03d}"
+    readers = [
+        Reader(login(client, f"load{run}-{n}@load.test")) for n in range(args.users)
+    ]
+
+    author = login(client, f"load{run}-author@load.test")
+    lines = (
+        json.dumps({"name": f"load {run} {n}", "path": f"/load/{n}", "price": 9.99})
+        for n in range(args.books)
+    )
+    status, body, _ = client.request(
+        "POST",
+        "/publish/bulk",
+        "\n".join(lines).encode("utf-8"),
+        author,
+        "application/x-ndjson",
+    )
+    if status != 200:
+        raise RuntimeError(f"publishing failed: {status} {body[:200]}")
+
+    books = []
+    path = "/published?limit=1000"
+    while path:
+        status, body, headers = client.request("GET", path, token=author)
+        books.extend(book["id"] for book in json.loads(body))
+        cursor = headers.get("X-Next-Cursor")
+        path = f"/published?limit=1000&after={cursor}" if cursor else None
+
+    for reader in readers:
+        reader.to_buy = random.sample(books, min(len(books), args.purchases))
+    return readers
+
+
+def parse_mix(mix):
+    """Returns the routes and weights of a mix such as book=70,purchase=30"""
+    routes, weights = [], []
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        routes.append(route.strip())
+        weights.append(float(weight))
+    return routes, weights
+
+
+def next_request(route, reader):
+    """
+    Returns the (name, method, path, body, on_success) of a request of
+    route for reader, falling back to a catalog read when reader has
+    nothing left to do for route
+    """
+    if route == "purchase" and reader.to_buy:
+        book_id = reader.to_buy.pop()
+        return (
+            "POST /purchase",
+            "POST",
+            "/purchase",
+            {"book_id": book_id, "amount": 9.99},
+            lambda: reader.to_read.append(book_id),
+        )
+
+    if route == "reading" and reader.to_read:
+        book_id = reader.to_read.pop()
+        return (
+            "POST /reading",
+            "POST",
+            "/reading",
+            {"book_id": book_id},
+            lambda: reader.to_complete.append(book_id),
+        )
+
+    if route == "completed" and reader.to_complete:
+        book_id = reader.to_complete.pop()
+        return "PUT /completed", "PUT", "/completed", {"book_id": book_id}, None
+
+    return "GET /book", "GET", "/book", None, None
+
+
+class Recorder:
+    """Collects the latency and outcome of every request by route"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(name, []).append((seconds, ok))
+
+    def report(self, elapsed):
+        """Returns throughput, percentiles and error rates as a dict"""
+
+        def summary(samples):
+            latencies = sorted(seconds for seconds, _ in samples)
+            errors = sum(1 for _, ok in samples if not ok)
+
+            def percentile(p):
+                index = max(0, int(round(p / 100 * len(latencies))) - 1)
+                return round(latencies[index] * 1000, 3)
+
+            return {
+                "requests": len(samples),
+                "throughput": round(len(samples) / elapsed, 1),
+                "errors": errors,
+                "error_rate": round(errors / len(samples), 4),
+                "p50_ms": percentile(50),
+                "p95_ms": percentile(95),
+                "p99_ms": percentile(99),
+                "max_ms": round(latencies[-1] * 1000, 3),
+            }
+
+        with self.lock:
+            routes = {name: summary(s) for name, s in sorted(self.samples.items())}
+            everything = [sample for s in self.samples.values() for sample in s]
+        return {"overall": summary(everything) if everything else {}, "routes": routes}
+
+
+def send(client, reader, route, recorder, due):
+    """Sends one request of route and records it, timed from due"""
+    name, method, path, body, on_success = next_request(route, reader)
+    try:
+        status, _, _ = client.request(method, path, body, reader.token)
+        ok = status < 400
+
+    except (http.client.HTTPException, OSError):
+        ok = False
+
+    recorder.record(name, time.perf_counter() - due, ok)
+    if ok and on_success:
+        on_success()
+
+
+def closed_loop(port, readers, routes, weights, args, recorder):
+    """Runs --concurrency clients, each owning a share of the readers"""
+
+    def worker(share, deadline):
+        client = Client(port)
+        while time.perf_counter() < deadline:
+            reader = random.choice(share)
+            route = random.choices(routes, weights)[0]
+            send(client, reader, route, recorder, time.perf_counter())
+
+    deadline = time.perf_counter() + args.duration
+    threads = []
+    for n in range(args.concurrency):
+        share = readers[n :: args.concurrency] or readers
+        thread = threading.Thread(target=worker, args=(share, deadline))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def open_loop(port, readers, routes, weights, args, recorder):
+    """
+    Sends --rate requests per second with exponential inter-arrival times.
+    A reader is only used by one request at a time.
+    """
+    local = threading.local()
+    idle = list(readers)
+    idle_lock = threading.Lock()
+
+    def task(route, due):
+        if not hasattr(local, "client"):
+            local.client = Client(port)
+        with idle_lock:
+            reader = idle.pop(random.randrange(len(idle))) if idle else None
+        if reader is None:
+            # every reader is busy, so read the catalog as anyone
+            send(local.client, random.choice(readers), "book", recorder, due)
+            return
+
+        try:
+            send(local.client, reader, route, recorder, due)
+        finally:
+            with idle_lock:
+                idle.append(reader)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        start = time.perf_counter()
+        due = start
+        while due < start + args.duration:
+            due += random.expovariate(args.rate)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            route = random.choices(routes, weights)[0]
+            executor.submit(task, route, due)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--purchases", type=int, default=50, help="per user")
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=200, help="open loop req/s")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--ephemeral", action="store_true", help="throwaway DB")
+    parser.add_argument("--pg-bin", help="directory of initdb and pg_ctl")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+    routes, weights = parse_mix(args.mix)
+
+    env = {**os.environ, "LOG_LEVEL": "WARNING"}
+    database = None
+    if args.ephemeral:
+        database = EphemeralPostgres(args.pg_bin)
+        env.update(database.start())
+
+    port = free_port()
+    env["PORT"] = str(port)
+    server = None
+    try:
+        if args.ephemeral:
+            subprocess.run([sys.executable, "migrate.py"], cwd=SRC, env=env, check=True)
+
+        server = subprocess.Popen(
+            [sys.executable, "manage.py"],
+            cwd=SRC,
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        wait_for_port(port, 30, server)
+
+        started = time.perf_counter()
+        readers = setup(port, args)
+        print(
+            f"set up {len(readers)} users in {time.perf_counter() - started:.1f}s",
+            file=sys.stderr,
+        )
+
+        recorder = Recorder()
+        run = closed_loop if args.mode == "closed" else open_loop
+        started = time.perf_counter()
+        run(port, readers, routes, weights, args, recorder)
+        elapsed = time.perf_counter() - started
+
+        report = {
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "rate": args.rate if args.mode == "open" else None,
+            "duration_s": round(elapsed, 2),
+            "mix": args.mix,
+            "users": args.users,
+            **recorder.report(elapsed),
+        }
+        output = json.dumps(report, indent=2)
+        print(output)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                file.write(output + "\n")
+
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if database is not None:
+            database.stop()
+
+
+if __name__ == "__main__":
+    main()
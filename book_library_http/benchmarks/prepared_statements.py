@@ -0,0 +1,94 @@
+"""
+Compares the prepared statements of statements.py with running the same
+queries through cursor.execute, which Postgres parses and plans every time.
+
+The sample rows are created inside a transaction that is rolled back at the
+end, so run it against a local database:
+
+    python benchmarks/prepared_statements.py --repeat 5000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+import statements
+from config import get_connection
+
+SEED = """
+INSERT INTO public.user (name, email, password)
+VALUES ('bench', 'bench@bench.local', ''::bytea) RETURNING id
+"""
+
+
+def seed(cursor):
+    """Creates a user with a token, a book and purchases; returns parameters"""
+    cursor.execute(SEED)
+    user_id = cursor.fetchone()[0]
+    cursor.execute(
+        """INSERT INTO public.user_token (user_id, token, expiration_time)
+        VALUES (%s, 'bench-token', now() + interval '1 hour')""",
+        (user_id,),
+    )
+    cursor.execute(
+        """INSERT INTO public.book (name, file_path, price)
+        VALUES ('bench', '/bench.pdf', 9.99) RETURNING id"""
+    )
+    book_id = cursor.fetchone()[0]
+    cursor.execute(
+        """INSERT INTO public.transactions (user_id, book_id, amount, time)
+        SELECT %s, %s, 9.99, now() FROM generate_series(1, 20)""",
+        (user_id, book_id),
+    )
+    return {
+        "validate_token": ("bench-token", datetime.datetime.now()),
+        "authenticate": ("bench@bench.local",),
+        "book_by_id": (book_id,),
+        "transactions_by_user": (user_id, 0, 101),
+        "transactions_by_user_book": (user_id, book_id, 0, 101),
+    }
+
+
+def timed(run, repeat):
+    """Returns the mean time of run in microseconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        params = seed(cursor)
+
+        for name, record in params.items():
+
+            def ad_hoc():
+                cursor.execute(statements.STATEMENTS[name], record)
+                cursor.fetchall()
+
+            def prepared():
+                statements.execute(cursor, name, record)
+                cursor.fetchall()
+
+            ad_hoc_us = timed(ad_hoc, args.repeat)
+            prepared_us = timed(prepared, args.repeat)
+            print(
+                f"{name}: execute {ad_hoc_us:.0f} us, prepared {prepared_us:.0f} us "
+                f"({ad_hoc_us / prepared_us:.2f}x)"
+            )
+
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
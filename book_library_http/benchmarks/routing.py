@@ -0,0 +1,117 @@
+"""
+Measures the cost of routing a request with router.Router, against trying
+the routes one by one as compiled regular expressions, as the number of
+routes grows; then the cost of the middleware chain around a handler.
+
+Nothing is sent to the database:
+
+    python benchmarks/routing.py --repeat 100000
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+from manage import ROUTER
+from router import Response, Router, chain
+
+# requests routed by the server, as (method, path)
+REQUESTS = (
+    ("GET", "/book"),
+    ("GET", "/book/1234"),
+    ("POST", "/purchase"),
+    ("PUT", "/completed"),
+    ("DELETE", "/user/42"),
+    ("GET", "/transaction/author"),
+)
+
+
+def timed(run, repeat):
+    """Returns the mean time of run in microseconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def synthetic(count):
+    """
+    Returns count route patterns of two to four segments, half of them with
+    an int parameter, and a path matching the last one
+    """
+    patterns = []
+    for index in range(count):
+        pattern = f"/resource{index}/item"
+        if index % 2:
+            pattern += "/{item_id:int}"
+        if index % 3 == 0:
+            pattern += "/detail"
+        patterns.append(pattern)
+    path = re.sub(r"\{[^}]+\}", "1234", patterns[-1])
+    return patterns, path
+
+
+def regex_router(patterns):
+    """Returns a function matching a path against the patterns in order"""
+    compiled = [
+        re.compile(
+            "^"
+            + re.sub(
+                r"\{(\w+):int\}",
+                r"(?P<\1>[0-9]+)",
+                pattern,
+            )
+            + "$"
+        )
+        for pattern in patterns
+    ]
+
+    def match(path):
+        for regex in compiled:
+            found = regex.match(path)
+            if found:
+                return regex, found.groupdict()
+        return None
+
+    return match
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=100000)
+    args = parser.parse_args()
+
+    for method, path in REQUESTS:
+        match_us = timed(lambda: ROUTER.match(method, path), args.repeat)
+        print(f"{method} {path}: {match_us:.2f} us")
+
+    for count in (10, 100, 1000):
+        patterns, path = synthetic(count)
+        router = Router()
+        for pattern in patterns:
+            router.add("GET", pattern, None)
+        linear = regex_router(patterns)
+
+        tree_us = timed(lambda: router.match("GET", path), args.repeat)
+        regex_us = timed(lambda: linear(path), max(1, args.repeat // count))
+        print(
+            f"{count} routes: tree {tree_us:.2f} us, regex scan {regex_us:.2f} us "
+            f"({regex_us / tree_us:.1f}x)"
+        )
+
+    response = Response(204)
+    for layers in (0, 5, 10):
+        handler = chain(
+            [lambda request, call_next: call_next(request)] * layers,
+            lambda request: response,
+        )
+        chain_us = timed(lambda: handler(None), args.repeat)
+        print(f"{layers} middleware: {chain_us:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
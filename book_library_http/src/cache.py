@@ -0,0 +1,216 @@
+"""
+In-process caches shared by the controllers
+"""
+import secrets
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from config import (
+    COMPRESS_CACHE_SIZE,
+    COMPRESS_CACHE_TTL,
+    TOKEN_CACHE_SIZE,
+    TOKEN_CACHE_TTL,
+)
+
+
+class TTLCache:
+    """
+    Thread safe, size bounded LRU cache whose entries also expire after a
+    time to live. Keeps hit and miss counters for monitoring.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if missing or expired
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                deadline, value = entry
+                if deadline > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._data[key]
+                self._removed(key, value)
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Caches value under key for ttl seconds, capped at the cache's ttl
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def pop(self, key):
+        """Removes key from the cache"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._removed(key, entry[1])
+
+    def _store(self, key, value, ttl):
+        # called with the lock held
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._removed(key, entry[1])
+        self._data[key] = (time.monotonic() + ttl, value)
+        while len(self._data) > self.maxsize:
+            evicted, (_, old) = self._data.popitem(last=False)
+            self._removed(evicted, old)
+
+    def _removed(self, key, value):
+        """Called with the lock held for every entry dropped from the cache"""
+
+    def clear(self):
+        """Removes every entry"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Returns hit, miss and size counters"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class TokenCache(TTLCache):
+    """
+    Cache of validated tokens, mapping a token to the user it belongs to.
+    Keeps the cached tokens of every user, so that invalidating a user only
+    touches its own tokens, and the generation of its last invalidation, so
+    that a token read from the database before it is not cached after it.
+    Generations are only kept while a read that started before them is in
+    flight.
+    """
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self._generation = 0
+        # user_id: generation of its last invalidation, oldest first
+        self._invalidated = OrderedDict()
+        # generation: reads in flight that started at it
+        self._readers = Counter()
+        self._tokens = {}
+
+    @contextmanager
+    def reading(self):
+        """
+        Wraps a read of a token from the database, yielding the generation
+        to pass to set
+        """
+        with self._lock:
+            since = self._generation
+            self._readers[since] += 1
+        try:
+            yield since
+
+        finally:
+            with self._lock:
+                self._readers[since] -= 1
+                if not self._readers[since]:
+                    del self._readers[since]
+                self._prune()
+
+    def _prune(self):
+        # called with the lock held; drops the invalidations no read in
+        # flight started before
+        oldest = min(self._readers, default=self._generation)
+        while self._invalidated:
+            user_id, generation = next(iter(self._invalidated.items()))
+            if generation > oldest:
+                break
+            del self._invalidated[user_id]
+
+    def set(self, key, value, ttl=None, since=None):
+        """
+        Caches the user value under the token key, unless the user was
+        invalidated after generation since, when the token was read
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        user_id = value["user_id"]
+        with self._lock:
+            if since is not None and self._invalidated.get(user_id, 0) > since:
+                return
+
+            self._store(key, value, ttl)
+            # unless it was evicted at once, as by a cache of size 0
+            if key in self._data:
+                self._tokens.setdefault(user_id, set()).add(key)
+
+    def invalidate_user(self, user_id):
+        """Drops every cached token of user_id"""
+        with self._lock:
+            self._generation += 1
+            self._invalidated.pop(user_id, None)
+            self._invalidated[user_id] = self._generation
+            self._prune()
+            for token in self._tokens.pop(user_id, ()):
+                self._data.pop(token, None)
+
+    def _removed(self, key, value):
+        tokens = self._tokens.get(value["user_id"])
+        if tokens is not None:
+            tokens.discard(key)
+            if not tokens:
+                del self._tokens[value["user_id"]]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tokens.clear()
+
+
+class TableVersions:
+    """
+    Version counter of every table, bumped by the controllers after they
+    commit a change to it and by changes.py when any process changed it.
+    With the boot nonce, which differs on every start and every reset, the
+    versions identify what a response read and so make its ETag.
+    """
+
+    def __init__(self):
+        self.boot = secrets.token_hex(4)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Marks every table as changed, as when changes may have been missed"""
+        with self._lock:
+            self.boot = secrets.token_hex(4)
+
+    def bump(self, *tables):
+        """Marks tables as changed"""
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def get(self, *tables):
+        """Returns the current versions of tables"""
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in tables)
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+# compressed response bodies by (digest of the body, encoding)
+compressed_bodies = TTLCache(COMPRESS_CACHE_SIZE, COMPRESS_CACHE_TTL)
+table_versions = TableVersions()
@@ -0,0 +1,77 @@
+"""
+Follows the changes committed to the tables by any process. The triggers of
+migration 0007 notify the table_changed channel, and a background thread
+bumps the version of the notified table, so that the ETags of conditional
+GETs also change after provision_users.py, the dataset generator or a
+manual change wrote to a table.
+"""
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+
+from cache import table_versions
+from config import DATABASE
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "table_changed"
+# seconds between checks that the listening connection is still alive
+HEARTBEAT_INTERVAL = 30
+# seconds to wait before listening again after the connection was lost
+RECONNECT_DELAY = 5
+
+
+def listen(conn):
+    """
+    Bumps the version of every table notified on conn until it fails
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"LISTEN {CHANNEL}")
+    # changes committed while nothing listened were missed
+    table_versions.reset()
+
+    while True:
+        readable, _, _ = select.select([conn], [], [], HEARTBEAT_INTERVAL)
+        if not readable:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+        conn.poll()
+        while conn.notifies:
+            table_versions.bump(conn.notifies.pop(0).payload)
+
+
+def follow():
+    """
+    Listens for table changes on a connection of its own, outside the pool,
+    reconnecting whenever it is lost
+    """
+    while True:
+        try:
+            conn = psycopg2.connect(**DATABASE)
+
+        except psycopg2.Error as err:
+            logger.warning("cannot listen for table changes: %s", err)
+
+        else:
+            conn.autocommit = True
+            try:
+                listen(conn)
+
+            except psycopg2.Error as err:
+                logger.warning("stopped listening for table changes: %s", err)
+
+            finally:
+                conn.close()
+
+        time.sleep(RECONNECT_DELAY)
+
+
+def start():
+    """Follows table changes on a daemon thread"""
+    thread = threading.Thread(target=follow, name="table-changes", daemon=True)
+    thread.start()
+    return thread
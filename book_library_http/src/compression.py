@@ -0,0 +1,66 @@
+"""
+Compresses response bodies with the encoding a client prefers. zstd is
+offered when the optional zstandard package is installed, gzip always.
+"""
+import gzip
+import threading
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional speedup
+    zstandard = None
+
+from config import GZIP_LEVEL, ZSTD_LEVEL
+
+_local = threading.local()
+
+
+def _gzip(body):
+    # no timestamp, so the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _zstd(body):
+    # compressors are not thread safe, so every thread keeps its own
+    compressor = getattr(_local, "zstd", None)
+    if compressor is None:
+        compressor = _local.zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return compressor.compress(body)
+
+
+# supported encodings, the preferred first
+ENCODINGS = {"zstd": _zstd, "gzip": _gzip} if zstandard else {"gzip": _gzip}
+
+
+def negotiate(accept_encoding):
+    """
+    Returns the supported encoding the Accept-Encoding header ranks highest,
+    the preferred one on a tie, or None if the body should be sent as is
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            accepted[coding] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding):
+    """Returns body compressed with encoding, one of ENCODINGS"""
+    return ENCODINGS[encoding](body)
@@ -1,15 +1,224 @@
 """
 Creates a connection between backend and database
 """
+import os
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+from psycopg2 import extensions, pool
+
+import dbstats
+import metrics
+
+DATABASE = {
+    "database": os.environ.get("DB_NAME", "postgres"),
+    "user": os.environ.get("DB_USER", "postgres"),
+    "password": os.environ.get("DB_PASSWORD", "newPassword"),
+    "host": os.environ.get("DB_HOST", "127.0.0.1"),
+    "port": os.environ.get("DB_PORT", "5432"),
+}
+
+# bounds of the shared connection pool
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN", 1))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX", 10))
+# seconds a caller waits for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+# connections idle for longer than this are pinged before being handed out
+POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_POOL_HEALTH_CHECK", 30))
+
+# validated tokens kept in memory, and for how many seconds at most
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", 300))
+
+# bcrypt cost factor; stored hashes are upgraded on login when it changes
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+# worker processes hashing passwords, and calls allowed to wait for one
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_DEPTH = int(os.environ.get("HASH_QUEUE_DEPTH", 64))
+
+# rows returned by list endpoints when no limit, and at most, is given
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+# send the database work of every request as Server-Timing and X-DB-*
+# response headers
+DEBUG = os.environ.get("DEBUG", "").lower() in ("1", "true", "yes")
+# statements a request may execute before a warning is logged
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", 10))
+
+# response bodies smaller than this are sent uncompressed; the gzip and
+# zstd levels used for the rest
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", 3))
+# compressed bodies of responses with an ETag kept for reuse, and how long
+COMPRESS_CACHE_SIZE = int(os.environ.get("COMPRESS_CACHE_SIZE", 1000))
+COMPRESS_CACHE_TTL = float(os.environ.get("COMPRESS_CACHE_TTL", 300))
+
+# books that can be bought in a single /purchase order
+MAX_CART_SIZE = int(os.environ.get("MAX_CART_SIZE", 100))
+
+# books inserted per statement by /publish/bulk, and rejected rows reported
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 1000))
+BULK_MAX_ERRORS = int(os.environ.get("BULK_MAX_ERRORS", 1000))
+# bytes of validated books kept in memory while a bulk body is read, before
+# they are spooled to a temporary file
+BULK_SPOOL_SIZE = int(os.environ.get("BULK_SPOOL_SIZE", 4 * 1024 * 1024))
+# users hashed and copied per transaction by provision_users.py
+PROVISION_BATCH_SIZE = int(os.environ.get("PROVISION_BATCH_SIZE", 5000))
+
+
+class Connection(extensions.connection):
+    """
+    Database connection that remembers the statements prepared on it, see
+    statements.py, and whose cursors count their statements, see dbstats.py
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        cursor_class = cursor_factory or self.cursor_factory or extensions.cursor
+        return super().cursor(
+            *args, cursor_factory=dbstats.counting(cursor_class), **kwargs
+        )
+
+
+class ConnectionPool:
+    """
+    Bounded, thread safe pool of database connections. Callers block until a
+    connection is free instead of failing when the pool is exhausted, and idle
+    connections are health checked before they are reused.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, health_check_interval, **kwargs):
+        self._pool = pool.ThreadedConnectionPool(
+            minconn, maxconn, connection_factory=Connection, **kwargs
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+        self._health_check_interval = health_check_interval
+        self._last_used = {}
+
+    def _healthy(self, conn):
+        # checks that a connection can still be used
+        if conn.closed:
+            return False
+
+        status = conn.info.transaction_status
+        if status != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self._health_check_interval:
+            return True
+
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def getconn(self):
+        """
+        Checks out a healthy connection, waiting for a free slot if required
+        """
+        if not self._slots.acquire(timeout=self._timeout):
+            raise pool.PoolError("Timed out waiting for a database connection")
+
+        try:
+            while True:
+                conn = self._pool.getconn()
+                if self._healthy(conn):
+                    return conn
+
+                self._discard(conn)
+
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """
+        Returns a connection to the pool, dropping it if it is no longer usable
+        """
+        try:
+            if conn.closed:
+                self._discard(conn)
+                return
+
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+
+            self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn)
+
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn):
+        # closes a broken connection and frees its place in the pool
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    def closeall(self):
+        """Closes every connection held by the pool"""
+        self._pool.closeall()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process wide connection pool, creating it on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    POOL_MIN_SIZE,
+                    POOL_MAX_SIZE,
+                    POOL_TIMEOUT,
+                    POOL_HEALTH_CHECK_INTERVAL,
+                    **DATABASE,
+                )
+    return _pool
+
+
+@contextmanager
+def get_connection(*, autocommit=False):
+    """
+    Checks out a pooled connection between backend and database. The
+    connection is always handed back to the pool, and any transaction left
+    open by the caller is rolled back. Read only callers should pass
+    autocommit=True so that no transaction is opened at all.
+    """
+    connection_pool = get_pool()
+    start = time.perf_counter()
+    with metrics.phase("pool_wait"):
+        conn = connection_pool.getconn()
+    dbstats.connection()
+    metrics.observe("db_pool_wait_seconds", (), time.perf_counter() - start)
 
+    try:
+        conn.autocommit = autocommit
+        with metrics.phase("db"):
+            yield conn
 
-def get_connection():
-    # create a connection between database and backend
-    return psycopg2.connect(
-        database="postgres",
-        user="postgres",
-        password="newPassword",
-        host="127.0.0.1",
-        port="5432",
-    )
+    finally:
+        connection_pool.putconn(conn)
@@ -2,13 +2,113 @@
 Contains all the operations concerning the book. Operations such as
 insert, update, delete, retrieve.
 """
-import decimal
+import csv
 import json
+import logging
+import re
+import tempfile
 
 import psycopg2
 from psycopg2 import extras
 
-from config import get_connection
+from cache import table_versions
+from config import BULK_BATCH_SIZE, BULK_MAX_ERRORS, BULK_SPOOL_SIZE, get_connection
+from pagination import decode_cursor, encode_cursor, is_id, page_bounds, split_page
+import statements
+
+logger = logging.getLogger(__name__)
+
+INSERT_BOOK = """INSERT INTO public.book(name,file_path,price,
+    author_id, royalty) VALUES %s"""
+# every column of book returned to clients, which leaves out search
+BOOK_COLUMNS = "id, name, file_path, price, author_id, royalty, is_active"
+
+# every book, for admins
+CATALOG = f"""SELECT {BOOK_COLUMNS} FROM public.book
+    WHERE id > %s ORDER BY id LIMIT %s"""
+# the books a user may see: every active book and those the user bought or
+# wrote; the file path is only shown for books the user bought or wrote
+USER_CATALOG = """SELECT book.id, book.name, book.author_id, book.price,
+        CASE WHEN purchased.book_id IS NOT NULL OR book.author_id = %s
+            THEN book.file_path END AS file_path
+    FROM public.book
+    LEFT JOIN (
+        SELECT DISTINCT book_id FROM public.transactions WHERE user_id = %s
+    ) AS purchased ON purchased.book_id = book.id
+    WHERE (purchased.book_id IS NOT NULL OR book.author_id = %s
+        OR book.is_active = True OR book.author_id IS NULL)
+    AND book.id > %s ORDER BY book.id LIMIT %s"""
+# the books of an author, and one of them
+_BY_AUTHOR = f"""SELECT {BOOK_COLUMNS} FROM public.book WHERE author_id = %s{{}}
+    AND id > %s ORDER BY id LIMIT %s"""
+BOOKS_BY_AUTHOR = _BY_AUTHOR.format("")
+BOOK_BY_AUTHOR = _BY_AUTHOR.format(" AND id=%s")
+# books bought but not started yet
+PURCHASED = """SELECT id,name,author_id,price,file_path FROM public.book
+    WHERE EXISTS (
+        SELECT 1 FROM public.transactions
+        WHERE transactions.user_id = %s AND transactions.book_id = book.id
+    ) AND NOT EXISTS (
+        SELECT 1 FROM public.reading
+        WHERE reading.user_id = %s AND reading.book_id = book.id
+    ) AND id > %s ORDER BY id LIMIT %s"""
+
+# words of a search that are matched, at most
+MAX_SEARCH_TERMS = 8
+# active books matching a search, with their file path shown as in
+# retrieve_book; admins, with no user_id, see every file path. Pages
+# continue after the rank and id of after_id, unless it is NULL.
+_SEARCH = """SELECT id, name, author_id, price,
+        CASE WHEN purchased OR author_id = %(user_id)s OR %(user_id)s IS NULL
+            THEN file_path END AS file_path,
+        purchased, rank
+    FROM (
+        SELECT book.id, book.name, book.author_id, book.price,
+            book.file_path, ({rank})::real AS rank,
+            EXISTS (
+                SELECT 1 FROM public.transactions
+                WHERE transactions.user_id = %(user_id)s
+                AND transactions.book_id = book.id
+            ) AS purchased
+        FROM public.book, to_tsquery('english', %(terms)s) AS terms
+        WHERE book.is_active AND ({match})
+    ) AS found
+    WHERE (%(after_id)s IS NULL OR rank < %(rank)s::real
+        OR (rank = %(rank)s::real AND id > %(after_id)s))
+    ORDER BY rank DESC, id LIMIT %(limit)s"""
+# every word of the search matches whole words and their prefixes
+SEARCH_BOOKS = _SEARCH.format(
+    rank="ts_rank(book.search, terms)", match="book.search @@ terms"
+)
+# with pg_trgm, names similar to the search match too
+FUZZY_SEARCH_BOOKS = _SEARCH.format(
+    rank="greatest(ts_rank(book.search, terms),"
+    " similarity(lower(book.name), %(name)s))",
+    match="book.search @@ terms OR lower(book.name) %% %(name)s",
+)
+# whether pg_trgm is installed, looked up on the first search
+_trigrams = None
+
+
+def validate_book(name, path, price, author_id=None, royalty=None):
+    """
+    Checks the fields of a book before it is inserted.
+    Returns the error message, or None if the book is valid
+    """
+    if not all([name, path, price]):
+        return str(ValueError("Name, path, and price are required"))
+
+    fields = [(name, str), (path, str), (price, float)]
+    if author_id:
+        fields.append((author_id, int))
+
+    if royalty:
+        fields.append((royalty, float))
+
+    if not all(isinstance(field, field_type) for field, field_type in fields):
+        return str(ValueError("Invalid datatypes"))
+
+    return None
 
 
 def insert_book(*, name, path, price, author_id=None, royalty=None):
@@ -16,71 +116,224 @@ def insert_book(*, name, path, price, author_id=None, royalty=None):
     Inserts name, author_id, price, royalty and path of book.
     Returns false if unsuccesssful
     """
-    error = None
     flag = False
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    records = [name, path, price]
 
-    required_fields = [name, path, price]
-    if not all(required_fields):
-        error = str(ValueError("Name, path, and price are required"))
+    error = validate_book(name, path, price, author_id, royalty)
+    if error:
         status = False
         return {"status": status, "error": error}
 
-    if author_id:
-        required_fields.append(author_id)
+    records = (name, path, price, author_id or None, royalty or None)
 
-    if royalty:
-        required_fields.append(royalty)
+    insert_query = """INSERT INTO public.book(name,file_path,price,
+        author_id, royalty) VALUES(%s,%s,%s,%s,%s)"""
 
-    type_dict = {name: str, path: str, price: float}
-    if author_id:
-        type_dict[author_id] = int
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(insert_query, records)
+            conn.commit()
+            flag = True
+            table_versions.bump("book")
 
-    if royalty:
-        type_dict[royalty] = float
+        except psycopg2.Error as err:
+            error = str(err)
+            flag = False
 
-    if not all(isinstance(field, type_dict[field]) for field in required_fields):
-        error = str(ValueError("Invalid datatypes"))
-        status = False
-        return {"status": status, "error": error}
+    return {"status": flag, "error": error}
 
-    insert_query = """INSERT INTO public.book(name,file_path,price,
-        author_id, royalty) VALUES(%s,%s,%s,%s,%s)"""
 
-    if author_id:
-        records.append(int(author_id))
-        if royalty:
-            records.append(float(royalty))
-        else:
-            records.append(None)
+def ndjson_rows(lines):
+    """
+    Yields (line number, book) for every line of an NDJSON body. A line that
+    cannot be parsed is yielded as the ValueError describing it.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
 
-    else:
-        records.append(None)
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("Each line must be a JSON object")
+
+        except ValueError as err:
+            row = ValueError(str(err))
+
+        yield line_number, row
 
+
+def csv_rows(lines):
+    """
+    Yields (line number, book) for every record of a CSV body whose first
+    line holds the column names. Reading stops at the first malformed line,
+    which is yielded as the ValueError describing it.
+    """
+    reader = csv.DictReader(line.decode("utf-8") for line in lines)
     try:
-        cursor.execute(insert_query, records)
-        conn.commit()
-        flag = True
+        for row in reader:
+            yield reader.line_num, row
 
-    except psycopg2.Error as err:
-        error = str(err)
-        flag = False
+    except (csv.Error, UnicodeDecodeError) as err:
+        yield reader.line_num + 1, ValueError(str(err))
 
-    finally:
-        conn.close()
 
-    return {"status": flag, "error": error}
+def book_record(row, author_id=None):
+    """
+    Validates one book of a bulk import and returns the values to insert.
+    CSV fields are strings, so numbers are converted first. author_id, when
+    given, replaces the author of the row. Raises ValueError if invalid.
+    """
+    if author_id is None:
+        author_id = row.get("author_id")
+
+    values = {"price": row.get("price"), "author_id": author_id}
+    values["royalty"] = row.get("royalty")
+    for key, field_type in (("price", float), ("author_id", int), ("royalty", float)):
+        value = values[key]
+        if value == "":
+            values[key] = None
+
+        elif isinstance(value, str) or (
+            field_type is float and type(value) is int  # whole prices in JSON
+        ):
+            try:
+                values[key] = field_type(value)
+
+            except ValueError:
+                raise ValueError("Invalid datatypes") from None
+
+    name, path = row.get("name"), row.get("path")
+    error = validate_book(name, path, **values)
+    if error:
+        raise ValueError(error)
+
+    return (name, path, values["price"], values["author_id"], values["royalty"])
 
 
-def retrieve_book(user_id=None, book_id=None):
+def spool_books(rows, author_id, reject):
+    """
+    Validates the books yielded by rows and writes the values of the valid
+    ones to a temporary file, in memory up to BULK_SPOOL_SIZE bytes, passing
+    the invalid ones to reject. Returns the file, rewound.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=BULK_SPOOL_SIZE, mode="w+")
+    try:
+        for line_number, row in rows:
+            try:
+                if isinstance(row, ValueError):
+                    raise row
+                record = [line_number, *book_record(row, author_id)]
+
+            except ValueError as err:
+                reject(line_number, str(err))
+
+            else:
+                spool.write(json.dumps(record) + "\n")
+
+    except BaseException:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    return spool
+
+
+def spooled_batches(spool):
+    """
+    Yields the books of a spool BULK_BATCH_SIZE at a time, as lists of
+    (line number, values)
+    """
+    batch = []
+    for line in spool:
+        line_number, *values = json.loads(line)
+        batch.append((line_number, tuple(values)))
+        if len(batch) >= BULK_BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def insert_books(*, rows, author_id=None):
+    """
+    Inserts the books yielded by rows, as (line number, book) pairs, in one
+    transaction. Every row is read and validated first, and the valid books
+    spooled, so that a slow upload does not hold a pooled connection or an
+    open transaction. Books are then inserted BULK_BATCH_SIZE at a time, and
+    a batch the database rejects is retried book by book, so invalid books
+    are reported by line without aborting the import. author_id, when
+    given, is used as the author of every book.
     """
-    Retrieves book details according to book id
+    inserted = 0
+    rejected = []
+    rejected_count = 0
+
+    def reject(line_number, error):
+        nonlocal rejected_count
+        rejected_count += 1
+        if len(rejected) < BULK_MAX_ERRORS:
+            rejected.append({"line": line_number, "error": error})
+
+    with spool_books(rows, author_id, reject) as spool, get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            for batch in spooled_batches(spool):
+                inserted += insert_batch(cursor, batch, reject)
+            conn.commit()
+            table_versions.bump("book")
+
+        except psycopg2.Error as err:
+            return {"status": False, "error": str(err)}
+
+    rejected.sort(key=lambda error: error["line"])
+    return {
+        "status": True,
+        "error": None,
+        "data": {"inserted": inserted, "rejected": rejected_count, "errors": rejected},
+    }
+
+
+def insert_batch(cursor, batch, reject):
+    """
+    Inserts a batch of (line number, values) with one multi-row INSERT. If
+    it fails, every book is inserted on its own and the ones the database
+    rejects are passed to reject. Returns the number of books inserted.
+    """
+    cursor.execute("SAVEPOINT book_batch")
+    try:
+        extras.execute_values(
+            cursor, INSERT_BOOK, [values for _, values in batch], page_size=len(batch)
+        )
+        cursor.execute("RELEASE SAVEPOINT book_batch")
+        return len(batch)
+
+    except psycopg2.Error:
+        cursor.execute("ROLLBACK TO SAVEPOINT book_batch")
+        cursor.execute("RELEASE SAVEPOINT book_batch")
+
+    inserted = 0
+    for line_number, values in batch:
+        cursor.execute("SAVEPOINT book_row")
+        try:
+            extras.execute_values(cursor, INSERT_BOOK, [values])
+            inserted += 1
+
+        except psycopg2.Error as err:
+            cursor.execute("ROLLBACK TO SAVEPOINT book_row")
+            reject(line_number, err.diag.message_primary or str(err))
+
+        cursor.execute("RELEASE SAVEPOINT book_row")
+
+    return inserted
+
+
+def retrieve_book(user_id=None, book_id=None, limit=None, after=None):
+    """
+    Retrieves book details according to book id. Lists are returned one page
+    of limit books at a time, continuing after the cursor after.
     """
-    conn = get_connection()
-    cursor = conn.cursor(cursor_factory=extras.RealDictCursor)
     required_fields = []
 
     if user_id:
@@ -93,58 +346,53 @@ def retrieve_book(user_id=None, book_id=None):
         error = str(ValueError("Invalid datatypes"))
         status = False
         return {"status": status, "error": error}
+
+    try:
+        limit, after_id = page_bounds(limit, after)
+
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
     record = []
+    statement = None
 
     if not user_id:
-        query = """SELECT * FROM public.book"""
+        query = CATALOG
+        record = [after_id, limit + 1]
 
     elif book_id:
-        query = """SELECT id,name,author_id,price FROM public.book WHERE id=%s"""
+        statement = "book_by_id"
         record.append(book_id)
 
     elif user_id:
-        query = """SELECT id,name,author_id,price,file_path FROM public.book
-            WHERE id IN (
-                SELECT book_id FROM public.transactions WHERE user_id = %s
-            ) OR author_id = %s
-            UNION 
-            SELECT id, name, author_id, price, NULL AS file_path 
-            FROM public.book 
-            WHERE ((id NOT IN (
-                SELECT book_id FROM public.transactions WHERE user_id = %s
-            ) AND author_id != %s AND is_active = True) OR author_id IS NULL)
-        """
-        record.append(user_id)
+        query = USER_CATALOG
         record.append(user_id)
         record.append(user_id)
         record.append(user_id)
+        record.append(after_id)
+        record.append(limit + 1)
 
-    print(query)
-    cursor.execute(query, record)
-    result = cursor.fetchall()
-    print(result)
-
-    data = []
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor(cursor_factory=extras.RealDictCursor)
+        if statement:
+            statements.execute(cursor, statement, record)
 
-    for row in result:
-        data.append(dict(row))
+        else:
+            cursor.execute(query, record)
+        result = cursor.fetchall()
+    logger.debug("retrieved books", extra={"rows": len(result)})
 
-    for column_values in data:
-        for key, value in column_values.items():
-            if isinstance(value, decimal.Decimal):
-                column_values[key] = float(value)
+    data, has_more = split_page(result, limit)
 
-    data = json.dumps(data)
-    return {"status": True, "data": data}
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
 
 
-def retrieve_book_by_author(user_id, book_id=None):
+def retrieve_book_by_author(user_id, book_id=None, limit=None, after=None):
     """
-    Retrieves book details according to author
+    Retrieves book details according to author, one page at a time
     """
 
-    conn = get_connection()
-    cursor = conn.cursor(cursor_factory=extras.RealDictCursor)
     required_fields = [user_id]
     if not all(required_fields):
         error = str(ValueError("user_id are required"))
@@ -159,38 +407,105 @@ def retrieve_book_by_author(user_id, book_id=None):
         status = False
         return {"status": status, "error": error}
 
-    query = """SELECT * FROM public.book WHERE author_id = %s"""
+    try:
+        limit, after_id = page_bounds(limit, after)
 
-    if book_id:
-        query += """AND id=%s"""
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
 
-    cursor.execute(query, required_fields)
+    query = BOOK_BY_AUTHOR if book_id else BOOKS_BY_AUTHOR
+    record = required_fields + [after_id, limit + 1]
 
-    result = cursor.fetchall()
-    if not result:
-        return {"status": False, "error": "Book not found"}
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor(cursor_factory=extras.RealDictCursor)
+        cursor.execute(query, record)
+        result = cursor.fetchall()
 
-    data = []
+    if not result and after is None:
+        return {"status": False, "error": "Book not found", "not_found": True}
 
-    for row in result:
-        data.append(dict(row))
+    data, has_more = split_page(result, limit)
+
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
 
-    for column_values in data:
-        for key, value in column_values.items():
-            if isinstance(value, decimal.Decimal):
-                column_values[key] = float(value)
 
-    data = json.dumps(data)
-    return {"status": True, "data": data}
+def has_trigrams(cursor):
+    """
+    Returns True if pg_trgm is installed, which migration 0006 only does
+    where the extension is available. Looked up once per process.
+    """
+    global _trigrams
+    if _trigrams is None:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+        )
+        _trigrams = cursor.fetchone()["exists"]
+    return _trigrams
 
 
-def retrieve_purchased(user_id):
+def search_books(*, q, user_id=None, limit=None, after=None):
     """
-    Retrieves books that are purchased but not being read.
+    Searches the names of the active books, best match first. Every word of
+    q matches whole words and their prefixes; with pg_trgm, names that are
+    merely similar to q match too. Books the user bought are marked
+    purchased, and their file path shown as in retrieve_book. Pages continue
+    after the cursor after, which holds the rank and id of the last book of
+    the previous page.
     """
+    if not isinstance(q, str):
+        return {"status": False, "error": str(ValueError("q is required"))}
+
+    words = re.findall(r"\w+", q.lower())[:MAX_SEARCH_TERMS]
+    if not words:
+        return {"status": False, "error": str(ValueError("q is required"))}
+
+    if user_id is not None and not isinstance(user_id, int):
+        return {"status": False, "error": str(ValueError("Invalid datatypes"))}
+
+    try:
+        limit, _ = page_bounds(limit)
+        last = decode_cursor(after) if after is not None else None
+        if last is not None and not (
+            isinstance(last, list)
+            and len(last) == 2
+            and type(last[0]) in (int, float)
+            and is_id(last[1])
+        ):
+            raise ValueError("Invalid cursor")
+
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
+    rank, after_id = last if last is not None else (None, None)
+    record = {
+        # a prefix query per word, all of which must match
+        "terms": " & ".join(f"{word}:*" for word in words),
+        "name": " ".join(words),
+        "user_id": user_id,
+        "rank": rank,
+        "after_id": after_id,
+        "limit": limit + 1,
+    }
+
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor(cursor_factory=extras.RealDictCursor)
+        query = FUZZY_SEARCH_BOOKS if has_trigrams(cursor) else SEARCH_BOOKS
+        cursor.execute(query, record)
+        result = cursor.fetchall()
+    logger.debug("searched books", extra={"rows": len(result)})
 
-    conn = get_connection()
-    cursor = conn.cursor()
+    data, has_more = split_page(result, limit)
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor([data[-1]["rank"], data[-1]["id"]])
+    return {"status": True, "data": data, "next": next_cursor}
+
+
+def retrieve_purchased(user_id, limit=None, after=None):
+    """
+    Retrieves books that are purchased but not being read, one page at a time
+    """
 
     required_fields = [user_id]
 
@@ -204,48 +519,47 @@ def retrieve_purchased(user_id):
         status = False
         return {"status": status, "error": error}
 
+    try:
+        limit, after_id = page_bounds(limit, after)
+
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
     if user_id:
-        query = """SELECT book_id FROM public.transactions WHERE user_id = %s
-        EXCEPT SELECT book_id FROM public.reading WHERE user_id=%s"""
-        record = (user_id, user_id)
+        query = PURCHASED
+        record = (user_id, user_id, after_id, limit + 1)
 
     else:
         return {"status": False, "error": "Enter user id"}
 
-    cursor.execute(query, record if isinstance(record, tuple) else (record,))
-    result = cursor.fetchall()
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, record if isinstance(record, tuple) else (record,))
+        result = cursor.fetchall()
 
-    if not result:
-        return {"status": False, "error": "No purchased books left to start reading"}
+    if not result and after is None:
+        return {
+            "status": False,
+            "error": "No purchased books left to start reading",
+            "not_found": True,
+        }
 
-    book_ids = [row[0] for row in result]
+    result, has_more = split_page(result, limit)
     columns = ["id", "name", "author_id", "price", "file_path"]
 
-    query = """SELECT id,name,author_id,price,file_path FROM public.book WHERE
-    id = ANY(%s)"""
-    cursor.execute(query, (book_ids,))
-    result = cursor.fetchall()
-
     data = []
     for row in result:
         column_values = dict(zip(columns, row))
         data.append(column_values)
 
-    for column_values in data:
-        for key, value in column_values.items():
-            if isinstance(value, decimal.Decimal):
-                column_values[key] = float(value)
-
-    data = json.dumps(data)
-    return {"status": True, "data": data}
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
 
 
 def update_book(*, book_id, royalty=None, price=None):
     """
     Update royalty to author by user input
     """
-    conn = get_connection()
-    cursor = conn.cursor()
 
     required_fields = [book_id]
     if not all(required_fields):
@@ -275,7 +589,9 @@ def update_book(*, book_id, royalty=None, price=None):
     record = []
 
     if not price and not royalty:
-        return (False, "Enter price or royalty")
+        error = str(ValueError("Enter price or royalty"))
+        status = False
+        return {"status": status, "error": error}
 
     if royalty:
         query += """ royalty = %s """
@@ -283,36 +599,37 @@ def update_book(*, book_id, royalty=None, price=None):
 
     if price and not royalty:
         if royalty:
-            query += """AND"""
+            query += """ AND"""
 
         query += """ price = %s"""
         record.append(price)
 
-    query += """WHERE id = %s"""
+    query += """ WHERE id = %s"""
     record.append(book_id)
 
     error = None
     flag = False
-    try:
-        cursor.execute(query, record)
-        conn.commit()
-        flag = True
-
-    except AttributeError as err:
-        error = str(err)
-        flag = False
-
-    except psycopg2.Error as err:
-        error = str(err)
-        flag = False
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, record)
+            conn.commit()
+            flag = True
+            table_versions.bump("book")
+
+        except AttributeError as err:
+            error = str(err)
+            flag = False
+
+        except psycopg2.Error as err:
+            error = str(err)
+            flag = False
 
     return {"status": flag, "error": error}
 
 
 def update_book_author(*, user_id, book_id, price):
     """Updates the price of the book with id book_id and author user_id"""
-    conn = get_connection()
-    cursor = conn.cursor()
 
     required_fields = [book_id, user_id, price]
     if not all(required_fields):
@@ -332,18 +649,21 @@ def update_book_author(*, user_id, book_id, price):
 
     error = None
     flag = False
-    try:
-        cursor.execute(query, record)
-        conn.commit()
-        flag = True
-
-    except psycopg2.IntegrityError as err:
-        error = str(err)
-        flag = False
-
-    except psycopg2.DatabaseError as err:
-        error = str(err)
-        flag = False
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, record)
+            conn.commit()
+            flag = True
+            table_versions.bump("book")
+
+        except psycopg2.IntegrityError as err:
+            error = str(err)
+            flag = False
+
+        except psycopg2.DatabaseError as err:
+            error = str(err)
+            flag = False
 
     return {"status": flag, "error": error}
 
@@ -352,8 +672,6 @@ def delete_book(book_id, user_id):
     """
     Deacivate book by book id
     """
-    conn = get_connection()
-    cursor = conn.cursor()
     required_fields = [book_id, user_id]
 
     if not all(required_fields):
@@ -369,24 +687,27 @@ def delete_book(book_id, user_id):
     error = None
     flag = False
 
-    try:
-        cursor.execute(
-            """UPDATE public.book SET is_active = False
-        WHERE id = %s AND author_id=%s""",
-            (
-                book_id,
-                user_id,
-            ),
-        )
-        conn.commit()
-        flag = True
-
-    except psycopg2.IntegrityError as err:
-        error = str(err)
-        flag = False
-
-    except psycopg2.DatabaseError as err:
-        error = str(err)
-        flag = False
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """UPDATE public.book SET is_active = False
+            WHERE id = %s AND author_id=%s""",
+                (
+                    book_id,
+                    user_id,
+                ),
+            )
+            conn.commit()
+            flag = True
+            table_versions.bump("book")
+
+        except psycopg2.IntegrityError as err:
+            error = str(err)
+            flag = False
+
+        except psycopg2.DatabaseError as err:
+            error = str(err)
+            flag = False
 
     return {"status": flag, "error": error}
@@ -2,21 +2,100 @@
 Contain all the operations concerning the reading module. Operations such as
 insert, update, delete, retrieve.
 """
-import json
+import logging
+from datetime import date
+
 import psycopg2
-from .transaction import retrieve_transaction
+from cache import table_versions
 from config import get_connection
+from pagination import encode_cursor, page_bounds, split_page
+
+logger = logging.getLogger(__name__)
+
+# days of recent activity /engagement reports by default, and at most
+RECENT_DAYS = 7
+MAX_RECENT_DAYS = 90
+
+
+def count_readers(source, column):
+    """
+    Returns CTEs adding the rows of the CTE source, by book_id, to column,
+    started or completed, of the total and the day's counts of their books.
+    The day is a parameter, today as the server sees it like the window of
+    ENGAGEMENT, not the database's current_date.
+    """
+    return f"""{column}_total AS (
+        INSERT INTO public.book_engagement AS engagement (book_id, {column})
+        SELECT book_id, count(*) FROM {source} GROUP BY book_id
+        ON CONFLICT (book_id) DO UPDATE
+        SET {column} = engagement.{column} + EXCLUDED.{column}
+    ), {column}_today AS (
+        INSERT INTO public.book_engagement_daily AS daily (book_id, day, {column})
+        SELECT book_id, %s::date, count(*) FROM {source} GROUP BY book_id
+        ON CONFLICT (book_id, day) DO UPDATE
+        SET {column} = daily.{column} + EXCLUDED.{column}
+    )"""
+
+
+# one statement, so concurrent requests cannot insert the book twice, and
+# the reader is counted only when the row is created
+START_READING = (
+    """WITH purchased AS (
+    SELECT EXISTS (
+        SELECT 1 FROM public.transactions WHERE user_id = %s AND book_id = %s
+    ) AS is_purchased
+), inserted AS (
+    INSERT INTO public.reading (book_id,user_id)
+    SELECT %s,%s FROM purchased WHERE is_purchased
+    ON CONFLICT (user_id, book_id) DO NOTHING
+    RETURNING id, book_id
+), """
+    + count_readers("inserted", "started")
+    + """
+SELECT is_purchased, EXISTS (SELECT 1 FROM inserted) FROM purchased"""
+)
+# only a book that was not completed yet counts as a new completion
+COMPLETE_BOOK = (
+    """WITH updated AS (
+    UPDATE public.reading SET is_completed = True
+    WHERE book_id = %s and user_id = %s AND NOT is_completed
+    RETURNING book_id
+), """
+    + count_readers("updated", "completed")
+    + """
+SELECT count(*) FROM updated"""
+)
+# the books a user reads, and one of them
+_READINGS = """SELECT book_id, user_id, id, is_completed FROM public.reading
+    WHERE user_id = %s {}AND id > %s ORDER BY id LIMIT %s"""
+READINGS = _READINGS.format("")
+BOOK_READINGS = _READINGS.format("AND book_id = %s ")
+READINGS_BY_AUTHOR = """SELECT reading.book_id, reading.user_id, reading.id,
+    reading.is_completed FROM public.reading, public.book WHERE public.reading.book_id=
+    public.book.id AND public.book.author_id = %s AND public.reading.id > %s
+    ORDER BY public.reading.id LIMIT %s"""
+# readers of the books of an author, in all and over the days before today
+ENGAGEMENT = """SELECT book.id, book.name,
+        COALESCE(engagement.started, 0), COALESCE(engagement.completed, 0),
+        COALESCE(sum(daily.started), 0), COALESCE(sum(daily.completed), 0)
+    FROM public.book
+    LEFT JOIN public.book_engagement AS engagement ON engagement.book_id = book.id
+    LEFT JOIN public.book_engagement_daily AS daily
+        ON daily.book_id = book.id AND daily.day > %s::date - %s
+    WHERE book.author_id = %s AND book.id > %s
+    GROUP BY book.id, book.name, engagement.started, engagement.completed
+    ORDER BY book.id LIMIT %s"""
 
 
 def insert_reading(*, book_id, user_id):
     """
     This function takes user id, and book id and inserts it in the reading table.
     Returns true if operation was successful and false with error if unsuccessful.
+    The book must have been purchased, and data tells whether a new row was
+    created or the user was already reading the book.
     """
     error = None
     flag = False
-    conn = get_connection()
-    cursor = conn.cursor()
     required_fields = [user_id, book_id]
 
     if not all(required_fields):
@@ -29,41 +108,42 @@ def insert_reading(*, book_id, user_id):
         status = False
         return {"status": status, "error": error}
 
-    transaction = retrieve_transaction(user_id=user_id, book_id=book_id)
-    if transaction["status"] is False:
-        return {"status": False, "error": "Book not purchased"}
+    insert_query = START_READING
+    records = (user_id, book_id, book_id, user_id, date.today())
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(insert_query, records)
+            is_purchased, created = cursor.fetchone()
+            conn.commit()
 
-    reading = retrieve_reading(user_id=user_id, book_id=book_id)
-    if reading["status"] is True:
-        return reading
+            if not is_purchased:
+                return {"status": False, "error": "Book not purchased"}
 
-    insert_query = """INSERT INTO public.reading (book_id,user_id) VALUES(%s,%s)"""
-    records = (book_id, user_id)
-    try:
-        cursor.execute(insert_query, records)
-        conn.commit()
-        flag = True
+            if created:
+                table_versions.bump("reading")
 
-    except psycopg2.IntegrityError as err:
-        error = str(err)
-        flag = False
+            flag = True
 
-    except psycopg2.DatabaseError as err:
-        error = str(err)
-        flag = False
+        except psycopg2.IntegrityError as err:
+            error = str(err)
+            flag = False
 
-    finally:
-        conn.close()
+        except psycopg2.DatabaseError as err:
+            error = str(err)
+            flag = False
 
-    return {"status": flag, "error": error}
+    if not flag:
+        return {"status": flag, "error": error}
 
+    return {"status": flag, "error": error, "data": {"created": created}}
 
-def retrieve_reading(*, user_id, book_id=None):
+
+def retrieve_reading(*, user_id, book_id=None, limit=None, after=None):
     """
     This function takes user_id, book_id or both and retrieves matching columns from reading table.
+    Rows are returned one page of limit rows at a time, continuing after the cursor after.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
     required_fields = [user_id]
 
     if book_id:
@@ -79,26 +159,31 @@ def retrieve_reading(*, user_id, book_id=None):
         status = False
         return {"status": status, "error": error}
 
-    query = """SELECT * FROM public.reading WHERE """
-    records = []
-    if user_id:
-        query += "user_id = %s "
-        records.append(user_id)
+    try:
+        limit, after_id = page_bounds(limit, after)
 
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
+    query = READINGS
+    records = [user_id]
     if book_id:
-        if user_id:
-            query += "AND "
-        query += "book_id = %s "
+        query = BOOK_READINGS
         records.append(book_id)
 
-    cursor.execute(query, records)
-    result = cursor.fetchall()
-    print(result)
+    records.append(after_id)
+    records.append(limit + 1)
+
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, records)
+        result = cursor.fetchall()
+    logger.debug("retrieved readings", extra={"rows": len(result)})
 
-    if not result:
-        return {"status": False, "error": "No matching records"}
+    if not result and after is None:
+        return {"status": False, "error": "No matching records", "not_found": True}
 
-    conn.close()
+    result, has_more = split_page(result, limit)
     columns = ["book_id", "user_id", "id", "is_completed"]
 
     data = []
@@ -106,18 +191,16 @@ def retrieve_reading(*, user_id, book_id=None):
         column_values = dict(zip(columns, row))
         data.append(column_values)
 
-    data = json.dumps(data)
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
 
-    return {"status": True, "data": data}
+    return {"status": True, "data": data, "next": next_cursor}
 
 
-def retrieve_reading_by_author(*, user_id):
+def retrieve_reading_by_author(*, user_id, limit=None, after=None):
     """
-    This function takes user_id and retrieves books published by an author.
+    This function takes user_id and retrieves books published by an author, one page at a time.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    required_fields = []
+    required_fields = [user_id]
 
     if not all(required_fields):
         error = str(ValueError("User_id or book_id required"))
@@ -129,17 +212,25 @@ def retrieve_reading_by_author(*, user_id):
         status = False
         return {"status": status, "error": error}
 
-    query = """SELECT * FROM public.reading, public.book WHERE public.reading.book_id=
-    public.book.id AND public.book.author_id = %s"""
-    record = user_id
+    try:
+        limit, after_id = page_bounds(limit, after)
+
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
 
-    cursor.execute(query, record if isinstance(record, tuple) else (record,))
-    result = cursor.fetchall()
+    query = READINGS_BY_AUTHOR
+    record = (user_id, after_id, limit + 1)
 
-    if not result:
-        return {"status": False, "error": "No matching records"}
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, record if isinstance(record, tuple) else (record,))
+        result = cursor.fetchall()
 
-    print(result)
+    if not result and after is None:
+        return {"status": False, "error": "No matching records", "not_found": True}
+
+    logger.debug("retrieved readings", extra={"rows": len(result)})
+    result, has_more = split_page(result, limit)
 
     columns = ["book_id", "user_id", "id", "is_completed"]
 
@@ -148,10 +239,8 @@ def retrieve_reading_by_author(*, user_id):
         column_values = dict(zip(columns, row))
         data.append(column_values)
 
-    conn.close()
-
-    data = json.dumps(data)
-    return {"status": True, "data": data}
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
 
 
 def book_completed(*, book_id, user_id):
@@ -159,8 +248,6 @@ def book_completed(*, book_id, user_id):
     This function updates a book to be completed with regards to a user.
     Returns true if operation was successful and false with error if unsuccessful.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
     flag = True
     error = None
 
@@ -176,22 +263,78 @@ def book_completed(*, book_id, user_id):
         status = False
         return {"status": status, "error": error}
 
-    try:
-        cursor.execute(
-            """UPDATE public.reading SET is_completed = True 
-            WHERE book_id = %s and user_id = %s""",
-            (
-                book_id,
-                user_id,
-            ),
-        )
-        conn.commit()
+    update_query = COMPLETE_BOOK
 
-    except psycopg2.DatabaseError as err:
-        error = str(err)
-        flag = False
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(update_query, (book_id, user_id, date.today()))
+            (changed,) = cursor.fetchone()
+            conn.commit()
+            if changed:
+                table_versions.bump("reading")
 
-    finally:
-        conn.close()
+        except psycopg2.DatabaseError as err:
+            error = str(err)
+            flag = False
 
     return {"status": flag, "error": error}
+
+
+def retrieve_engagement(*, user_id, days=None, limit=None, after=None):
+    """
+    Returns, for every book written by user_id, the readers who started and
+    completed it, the completion rate, and readers started and completed per
+    day over the last days days. Served from the counters kept by
+    insert_reading and book_completed, one page of books at a time.
+    """
+    required_fields = [user_id]
+
+    if not all(required_fields):
+        error = str(ValueError("User_id required"))
+        return {"status": False, "error": error}
+
+    if not all(isinstance(field, int) for field in required_fields):
+        error = str(ValueError("Invalid datatypes"))
+        return {"status": False, "error": error}
+
+    days = RECENT_DAYS if days is None else days
+    if not isinstance(days, int) or not 1 <= days <= MAX_RECENT_DAYS:
+        error = str(ValueError(f"days must be between 1 and {MAX_RECENT_DAYS}"))
+        return {"status": False, "error": error}
+
+    try:
+        limit, after_id = page_bounds(limit, after)
+
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
+    # today as the server sees it, the date the ETag of /engagement covers
+    query = ENGAGEMENT
+    record = (date.today(), days, user_id, after_id, limit + 1)
+
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, record)
+        result = cursor.fetchall()
+
+    if not result and after is None:
+        return {"status": False, "error": "No matching records", "not_found": True}
+
+    result, has_more = split_page(result, limit)
+    data = []
+    for book, name, started, completed, recent_started, recent_completed in result:
+        data.append(
+            {
+                "book_id": book,
+                "name": name,
+                "started": started,
+                "completed": completed,
+                "completion_rate": round(completed / started, 4) if started else 0.0,
+                "started_per_day": round(recent_started / days, 2),
+                "completed_per_day": round(recent_completed / days, 2),
+            }
+        )
+
+    next_cursor = encode_cursor(data[-1]["book_id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
@@ -3,20 +3,23 @@ Contains operations regarding token model
 """
 
 
+import logging
 import uuid
 from datetime import datetime, timedelta
 
 import psycopg2
 from .user import authenticate
+from cache import token_cache
 from config import get_connection
+import statements
+
+logger = logging.getLogger(__name__)
 
 
 def insert_token(*, email, password):
     """
     Inserts token in user_token table with row user_id.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
 
     required_fields = [email, password]
 
@@ -31,7 +34,6 @@ def insert_token(*, email, password):
         return {"status": status, "error": error}
 
     auth = authenticate(email=email, password=password)
-    print(auth)
     if auth["status"]:
         user_id = auth["id"]
     else:
@@ -41,22 +43,24 @@ def insert_token(*, email, password):
     error = None
     expiration_time = datetime.now() + timedelta(seconds=3600)
 
-    try:
-        cursor.execute(
-            """INSERT INTO public.user_token (user_id,token,expiration_time)
-        VALUES(%s,%s,%s) ON CONFLICT (user_id) DO UPDATE SET user_id= %s, 
-        token= %s, expiration_time=%s""",
-            (user_id, token, expiration_time, user_id, token, expiration_time),
-        )
-        conn.commit()
-
-    except psycopg2.Error as err:
-        error = str(err)
-        flag = False
-        return {"status": flag, "error": error}
-
-    finally:
-        conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """INSERT INTO public.user_token (user_id,token,expiration_time)
+            VALUES(%s,%s,%s) ON CONFLICT (user_id) DO UPDATE SET user_id= %s, 
+            token= %s, expiration_time=%s""",
+                (user_id, token, expiration_time, user_id, token, expiration_time),
+            )
+            conn.commit()
+
+        except psycopg2.Error as err:
+            error = str(err)
+            flag = False
+            return {"status": flag, "error": error}
+
+    # the previous token of the user was replaced
+    token_cache.invalidate_user(user_id)
 
     return {"status": True, "token": token}
 
@@ -65,8 +69,6 @@ def validate_token(*, token):
     """
     Validates token and returns if user is admin
     """
-    conn = get_connection()
-    cursor = conn.cursor()
 
     required_fields = [token]
 
@@ -80,28 +82,24 @@ def validate_token(*, token):
         status = False
         return {"status": status, "error": error}
 
-    print(token)
+    cached_user = token_cache.get(token)
+    if cached_user:
+        return {"validated": True, "user": cached_user}
+
     current_time = datetime.now()
-    print(current_time)
-
-    cursor.execute(
-        """SELECT user_id, is_admin
-            FROM public.user, public.user_token 
-            WHERE public.user_token.user_id = public.user.id 
-            AND public.user.is_active = True 
-            AND public.user_token.token = %s 
-            AND public.user_token.expiration_time > %s""",
-        (
-            token,
-            current_time,
-        ),
-    )
-
-    result = cursor.fetchone()
-
-    print(result)
-    if result:
-        column_values = {"user_id": result[0], "is_admin": bool(result[1])}
-        return {"validated": True, "user": column_values}
+
+    # a token revoked while it is read must not be cached afterwards
+    with token_cache.reading() as generation:
+        with get_connection(autocommit=True) as conn:
+            cursor = conn.cursor()
+            statements.execute(cursor, "validate_token", (token, current_time))
+
+            result = cursor.fetchone()
+
+        if result:
+            column_values = {"user_id": result[0], "is_admin": bool(result[1])}
+            time_left = (result[2] - current_time).total_seconds()
+            token_cache.set(token, column_values, ttl=time_left, since=generation)
+            return {"validated": True, "user": column_values}
 
     return {"validated": False, "error": "Unauthorized, please login again"}
@@ -3,69 +3,213 @@ Contain all the operations concerning the transaction module. Operations such as
 insert, update, delete, retrieve.
 """
 import datetime
-import json
-import decimal
+import logging
 import psycopg2
-from .book import retrieve_book_by_author
-from config import get_connection
+from cache import table_versions
+from config import MAX_CART_SIZE, get_connection
+from pagination import encode_cursor, page_bounds, split_page
+import statements
+
+logger = logging.getLogger(__name__)
+
+# adds the purchases returned by the "purchase" CTE to the monthly totals of
+# their books, in the same statement and transaction as the purchase itself
+RECORD_EARNINGS = """earned AS (
+    INSERT INTO public.book_earnings AS earnings
+        (book_id, period, author_id, units, gross, royalty)
+    SELECT purchase.book_id, date_trunc('month', purchase.time)::date,
+        book.author_id, count(*), sum(purchase.amount),
+        sum(purchase.amount * COALESCE(book.royalty, 0) / 100)
+    FROM purchase JOIN public.book ON book.id = purchase.book_id
+    GROUP BY 1, 2, 3
+    ON CONFLICT (book_id, period) DO UPDATE SET
+        units = earnings.units + EXCLUDED.units,
+        gross = earnings.gross + EXCLUDED.gross,
+        royalty = earnings.royalty + EXCLUDED.royalty
+)"""
+
+# a purchase of one book, if it is active and not written by the buyer
+PURCHASE_BOOK = (
+    """WITH purchase AS (
+    INSERT INTO public.transactions (book_id,user_id,amount,time)
+    SELECT id,%s,%s,%s FROM public.book
+    WHERE id = %s AND is_active = True AND author_id IS DISTINCT FROM %s
+    RETURNING id, book_id, amount, time
+), """
+    + RECORD_EARNINGS
+    + """ SELECT id FROM purchase"""
+)
+# the purchases of a cart, of the books that can be bought
+PURCHASE_BOOKS = (
+    """WITH purchase AS (
+    INSERT INTO public.transactions (book_id,user_id,amount,time)
+    SELECT book.id,%s,item.amount,%s
+    FROM unnest(%s::integer[], %s::numeric[]) AS item(book_id, amount)
+    JOIN public.book ON book.id = item.book_id
+    WHERE book.is_active = True AND book.author_id IS DISTINCT FROM %s
+    RETURNING book_id, amount, time
+), """
+    + RECORD_EARNINGS
+    + """ SELECT book_id FROM purchase"""
+)
+BOOK_STATUS = """SELECT is_active, author_id FROM public.book WHERE id=%s"""
+# the sales of an author, and of one of its books
+_BY_AUTHOR = """SELECT transactions.user_id, transactions.book_id,
+    transactions.amount, transactions.time, transactions.id
+    FROM public.transactions, public.book WHERE
+    public.transactions.book_id = public.book.id AND public.book.author_id = %s{}
+    AND public.transactions.id > %s
+    ORDER BY public.transactions.id LIMIT %s"""
+TRANSACTIONS_BY_AUTHOR = _BY_AUTHOR.format("")
+TRANSACTIONS_BY_AUTHOR_BOOK = _BY_AUTHOR.format(" AND public.transactions.book_id = %s")
+# the earnings of an author, or of one of its books, per book, per month and
+# in all
+_EARNINGS = """SELECT totals.book_id, book.name, totals.period, totals.units,
+        totals.gross, totals.royalty
+    FROM (
+        SELECT book_id, period, COALESCE(sum(units), 0) AS units,
+            COALESCE(sum(gross), 0) AS gross,
+            round(COALESCE(sum(royalty), 0), 2) AS royalty,
+            GROUPING(book_id, period) AS level
+        FROM public.book_earnings WHERE author_id = %s{}
+        GROUP BY GROUPING SETS ((book_id), (period), ())
+    ) AS totals
+    LEFT JOIN public.book ON book.id = totals.book_id
+    ORDER BY totals.level, totals.book_id, totals.period"""
+EARNINGS = _EARNINGS.format("")
+BOOK_EARNINGS = _EARNINGS.format(" AND book_id = %s")
 
 
 def insert_transaction(*, user_id, book_id, amount):
     """
     This function takes book_id, user_id, amount
-    as input and adds it to user table.
+    as input and adds it to user table. The book must be active and must not
+    be written by the buyer; both are checked by the insert itself.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
     current_time = datetime.datetime.now()
     error = None
     flag = False
 
     required_fields = [user_id, book_id, amount]
-    type_dict = {user_id: int, book_id: int, amount: float}
+    field_types = [(user_id, int), (book_id, int), (amount, float)]
 
     if not all(required_fields):
         error = str(ValueError("User_id, book_id and amount are required"))
         status = False
         return {"status": status, "error": error}
 
-    if not all(isinstance(field, type_dict[field]) for field in required_fields):
+    if not all(isinstance(field, field_type) for field, field_type in field_types):
         error = str(ValueError("Invalid datatypes"))
         status = False
         return {"status": status, "error": error}
 
-    query = """SELECT is_active FROM public.book WHERE id=%s"""
-    cursor.execute(query, (book_id,))
-    result = cursor.fetchone()
-    if result[0] is False:
-        return {"status": False, "error": "Book is inactivated"}
+    insert_query = PURCHASE_BOOK
+    records = (user_id, amount, current_time, book_id, user_id)
 
-    for book in json.loads(retrieve_book_by_author(user_id)["data"]):
-        if book_id == book["id"]:
-            return {"status": False, "error": "Author cannot purchase their own book"}
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(insert_query, records)
+            if cursor.fetchone():
+                conn.commit()
+                flag = True
+                table_versions.bump("transactions")
 
-    insert_query = """INSERT INTO public.transactions
-    (book_id,user_id,amount,time) VALUES(%s,%s,%s,%s)"""
-    records = (book_id, user_id, amount, current_time)
+            else:
+                error = purchase_error(cursor, book_id=book_id, user_id=user_id)
 
-    try:
-        cursor.execute(insert_query, records)
-        conn.commit()
-        flag = True
+        except psycopg2.Error as err:
+            error = str(err)
+            flag = False
+
+    return {"status": flag, "error": error}
+
+
+def insert_transactions(*, user_id, items):
+    """
+    Purchases every book in items, a list of {"book_id", "amount"}, in one
+    transaction. Either all books are purchased or none are.
+    """
+    current_time = datetime.datetime.now()
+    error = None
+    flag = False
+
+    if not user_id or not items:
+        error = str(ValueError("User_id and items are required"))
+        return {"status": False, "error": error}
 
-    except psycopg2.Error as err:
-        error = str(err)
-        flag = False
+    if not isinstance(items, list) or len(items) > MAX_CART_SIZE:
+        error = str(
+            ValueError(f"items must be a list of at most {MAX_CART_SIZE} books")
+        )
+        return {"status": False, "error": error}
+
+    book_ids = []
+    amounts = []
+    for item in items:
+        if not isinstance(item, dict):
+            return {"status": False, "error": str(ValueError("Invalid datatypes"))}
+
+        book_id = item.get("book_id")
+        amount = item.get("amount")
+        if not isinstance(book_id, int) or not isinstance(amount, float):
+            return {"status": False, "error": str(ValueError("Invalid datatypes"))}
+
+        book_ids.append(book_id)
+        amounts.append(amount)
+
+    if len(set(book_ids)) != len(book_ids):
+        error = str(ValueError("A book can only be purchased once per order"))
+        return {"status": False, "error": error}
+
+    insert_query = PURCHASE_BOOKS
+    records = (user_id, current_time, book_ids, amounts, user_id)
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(insert_query, records)
+            purchased = {row[0] for row in cursor.fetchall()}
+            if len(purchased) == len(book_ids):
+                conn.commit()
+                flag = True
+                table_versions.bump("transactions")
+
+            else:
+                conn.rollback()
+                rejected = [book_id for book_id in book_ids if book_id not in purchased]
+                error = f"Books cannot be purchased: {rejected}"
+
+        except psycopg2.Error as err:
+            error = str(err)
+            flag = False
 
     return {"status": flag, "error": error}
 
 
-def retrieve_transaction(*, user_id, book_id=None):
+def purchase_error(cursor, *, book_id, user_id):
     """
-    Retrieves transaction details according to user_id
+    Explains why book_id could not be purchased by user_id
+    """
+    cursor.execute(BOOK_STATUS, (book_id,))
+    result = cursor.fetchone()
+
+    if not result:
+        return "Book not found"
+
+    if result[0] is False:
+        return "Book is inactivated"
+
+    if result[1] == user_id:
+        return "Author cannot purchase their own book"
+
+    return "Book cannot be purchased"
+
+
+def retrieve_transaction(*, user_id, book_id=None, limit=None, after=None):
+    """
+    Retrieves transaction details according to user_id, one page at a time
     """
-    conn = get_connection()
-    cursor = conn.cursor()
 
     required_fields = [user_id]
 
@@ -82,49 +226,46 @@ def retrieve_transaction(*, user_id, book_id=None):
         status = False
         return {"status": status, "error": error}
 
-    query = """SELECT * FROM public.transactions WHERE """
-    record = []
+    try:
+        limit, after_id = page_bounds(limit, after)
 
-    if user_id:
-        query += """user_id = %s"""
-        record.append(
-            user_id,
-        )
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
+    statement = "transactions_by_user"
+    record = [user_id]
 
     if book_id:
-        query += """AND book_id = %s"""
+        statement = "transactions_by_user_book"
         record.append(book_id)
 
+    record.append(after_id)
+    record.append(limit + 1)
+
     columns = ["user_id", "book_id", "amount", "time", "id"]
-    cursor.execute(query, record)
-    result = cursor.fetchall()
-    print(result)
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        statements.execute(cursor, statement, record)
+        result = cursor.fetchall()
+    logger.debug("retrieved transactions", extra={"rows": len(result)})
 
-    if not result:
-        return {"status": False, "error": "No matching records"}
+    if not result and after is None:
+        return {"status": False, "error": "No matching records", "not_found": True}
 
+    result, has_more = split_page(result, limit)
     data = []
     for row in result:
         column_values = dict(zip(columns, row))
         data.append(column_values)
 
-    for column_values in data:
-        for key, value in column_values.items():
-            if isinstance(value, decimal.Decimal):
-                column_values[key] = float(value)
-            elif isinstance(value, datetime.datetime):
-                column_values[key] = value.isoformat()
-
-    data = json.dumps(data)
-    return {"status": True, "data": data}
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
 
 
-def retrieve_transaction_by_author(*, user_id, book_id=None):
+def retrieve_transaction_by_author(*, user_id, book_id=None, limit=None, after=None):
     """
-    Retrieves transaction details according to author
+    Retrieves transaction details according to author, one page at a time
     """
-    conn = get_connection()
-    cursor = conn.cursor()
 
     required_fields = [user_id]
 
@@ -141,30 +282,70 @@ def retrieve_transaction_by_author(*, user_id, book_id=None):
         status = False
         return {"status": status, "error": error}
 
-    query = """SELECT * FROM public.transactions, public.book WHERE
-    public.transactions.book_id = public.book.id AND public.book.author_id = %s"""
+    try:
+        limit, after_id = page_bounds(limit, after)
 
-    if book_id:
-        query += """AND book_id = %s"""
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
+    query = TRANSACTIONS_BY_AUTHOR_BOOK if book_id else TRANSACTIONS_BY_AUTHOR
+    record = required_fields + [after_id, limit + 1]
 
-    cursor.execute(query, required_fields)
-    result = cursor.fetchall()
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, record)
+        result = cursor.fetchall()
     columns = ["user_id", "book_id", "amount", "time", "id"]
 
-    if not result:
-        return {"status": False, "error": "No matching records"}
+    if not result and after is None:
+        return {"status": False, "error": "No matching records", "not_found": True}
 
+    result, has_more = split_page(result, limit)
     data = []
     for row in result:
         column_values = dict(zip(columns, row))
         data.append(column_values)
 
-    for column_values in data:
-        for key, value in column_values.items():
-            if isinstance(value, decimal.Decimal):
-                column_values[key] = float(value)
-            elif isinstance(value, datetime.datetime):
-                column_values[key] = value.isoformat()
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
+
+
+def retrieve_earnings(*, user_id, book_id=None):
+    """
+    Returns the sales of the books written by user_id from the monthly totals
+    in book_earnings: units, gross and royalty per book, per month and in
+    all. Reads a few rows per book and month, however many sales there were.
+    """
+    required_fields = [user_id]
+
+    if not all(required_fields):
+        error = str(ValueError("User_id required"))
+        return {"status": False, "error": error}
+
+    if book_id:
+        required_fields.append(book_id)
+
+    if not all(isinstance(field, int) for field in required_fields):
+        error = str(ValueError("Invalid datatypes"))
+        return {"status": False, "error": error}
+
+    query = BOOK_EARNINGS if book_id else EARNINGS
+
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, required_fields)
+        result = cursor.fetchall()
+
+    data = {"books": [], "periods": [], "total": None}
+    for book, name, period, units, gross, royalty in result:
+        totals = {"units": units, "gross": gross, "royalty": royalty}
+        if book is not None:
+            data["books"].append({"book_id": book, "name": name, **totals})
+
+        elif period is not None:
+            data["periods"].append({"period": period.strftime("%Y-%m"), **totals})
+
+        else:
+            data["total"] = totals
 
-    data = json.dumps(data)
     return {"status": True, "data": data}
@@ -3,26 +3,33 @@ Contain all the operations concerning the user. Operations such as
 insert, update, delete, retrieve.
 """
 
-import json
-import bcrypt
+import logging
+
 import psycopg2
+from cache import table_versions, token_cache
 from config import get_connection
+from hashing import HashQueueFull, check_password, hash_password, needs_rehash
+from pagination import encode_cursor, page_bounds, split_page
+import statements
 
+logger = logging.getLogger(__name__)
 
-def insert_user(*, name, email, password, account_num=None, upi_id=None):
+# active users one page at a time, and a single active user
+_USERS = """SELECT id,name, email,bank_account, upi_id FROM
+    public.user WHERE is_active=True{} AND id > %s ORDER BY id LIMIT %s"""
+LIST_USERS = _USERS.format("")
+USER_BY_ID = _USERS.format(" AND id = %s")
+
+
+def validate_user(name, email, password, account_num=None, upi_id=None):
     """
-    This function takes name, email, password, account number, upi id
-    as input and adds it to user table. Returns true if operation was successful
-    and false with error if unsuccessful.
+    Checks the fields of a user before it is inserted.
+    Returns the error message, or None if the user is valid
     """
-    conn = get_connection()
-    cursor = conn.cursor()
     required_fields = [name, email, password]
 
     if not all(required_fields):
-        error = str(ValueError("Name, email, and password are required"))
-        status = False
-        return {"status": status, "error": error}
+        return str(ValueError("Name, email, and password are required"))
 
     if account_num:
         required_fields.append(account_num)
@@ -31,38 +38,54 @@ def insert_user(*, name, email, password, account_num=None, upi_id=None):
         required_fields.append(upi_id)
 
     if not all(isinstance(field, str) for field in required_fields):
-        error = str(ValueError("Invalid datatypes"))
+        return str(ValueError("Invalid datatypes"))
+
+    return None
+
+
+def insert_user(*, name, email, password, account_num=None, upi_id=None):
+    """
+    This function takes name, email, password, account number, upi id
+    as input and adds it to user table. Returns true if operation was successful
+    and false with error if unsuccessful.
+    """
+    error = validate_user(name, email, password, account_num, upi_id)
+    if error:
         status = False
         return {"status": status, "error": error}
 
-    password = password.encode("utf-8")
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password, salt)
+    try:
+        hashed_password = hash_password(password)
+
+    except HashQueueFull as err:
+        return {"status": False, "error": str(err)}
+
     insert_query = """INSERT INTO public.user (name,email,password,
     bank_account,upi_id) VALUES(%s,%s,%s,%s,%s)"""
     records = (name, email, hashed_password, account_num, upi_id)
     error = None
     flag = False
 
-    try:
-        cursor.execute(insert_query, records)
-        # commits query in the database
-        conn.commit()
-        flag = True
-
-    except psycopg2.Error as err:
-        error = str(err)
-        flag = False
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(insert_query, records)
+            # commits query in the database
+            conn.commit()
+            flag = True
+            table_versions.bump("user")
 
-    finally:
-        conn.close()
+        except psycopg2.Error as err:
+            error = str(err)
+            flag = False
 
     return {"status": flag, "error": error}
 
 
-def retrieve_user(*, user_id=None):
+def retrieve_user(*, user_id=None, limit=None, after=None):
     """
-    This function takes user_id .
+    This function takes user_id . Without it, active users are listed one
+    page of limit users at a time, continuing after the cursor after.
     """
 
     if user_id:
@@ -70,48 +93,52 @@ def retrieve_user(*, user_id=None):
             error = str(ValueError("Fields with invalid data: user_id"))
             return {"status": False, "error": error}
 
+    try:
+        limit, after_id = page_bounds(limit, after)
+
+    except ValueError as err:
+        return {"status": False, "error": str(err)}
+
     record = []
-    conn = get_connection()
-    cursor = conn.cursor()
 
     columns = ["id", "name", "email", "bank_account", "upi_id"]
-    query = """SELECT id,name, email,bank_account, upi_id FROM
-    public.user WHERE is_active=True"""
-
-    if user_id is None:
-        cursor.execute(query)
+    query = LIST_USERS
 
-    else:
-        query += """ AND id = %s"""
+    if user_id is not None:
+        query = USER_BY_ID
         record.append(user_id)
-        cursor.execute(query, (user_id,))
 
-    result = cursor.fetchall()
+    record.append(after_id)
+    record.append(limit + 1)
 
-    if not result:
-        print("User with id =", id, "does not exist")
-        return {"status": False, "error": "No user with matching id found"}
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, record)
+        result = cursor.fetchall()
+
+    if not result and after is None:
+        logger.debug("user not found", extra={"user_id": user_id})
+        return {
+            "status": False,
+            "error": "No user with matching id found",
+            "not_found": True,
+        }
 
-    print(result)
-    conn.close()
+    logger.debug("retrieved users", extra={"rows": len(result)})
+    result, has_more = split_page(result, limit)
     data = []
     for row in result:
         column_values = dict(zip(columns, row))
         data.append(column_values)
 
-    data = json.dumps(data)
-    return {"status": True, "data": data}
+    next_cursor = encode_cursor(data[-1]["id"]) if has_more else None
+    return {"status": True, "data": data, "next": next_cursor}
 
 
 def authenticate(*, email, password):
     """
     Authenticates user email by checking password entered
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    record = []
-    query = """ SELECT password,id FROM public.user WHERE is_active=True"""
-
     required_fields = ["email", "password"]
     if not all(required_fields):
         error = str(ValueError("Email, and password are required"))
@@ -123,11 +150,10 @@ def authenticate(*, email, password):
         status = False
         return {"status": status, "error": error}
 
-    query += """ AND email = %s"""
-    record.append(email)
-    cursor.execute(query, record)
-    result = cursor.fetchone()
-    print(result)
+    with get_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        statements.execute(cursor, "authenticate", (email,))
+        result = cursor.fetchone()
     if not result:
         return {"status": False, "error": "Invalid email"}
 
@@ -136,20 +162,53 @@ def authenticate(*, email, password):
     # retrieves the stored password
     stored_hash = result[0]
     stored_hash = bytes(stored_hash)
-    password_bytes = password.encode("utf-8")
 
-    if bcrypt.checkpw(password_bytes, stored_hash):
-        return {"status": True, "id": user_id}
+    try:
+        if not check_password(password, stored_hash):
+            return {"status": False, "error": "Invalid password"}
+
+    except HashQueueFull as err:
+        return {"status": False, "error": str(err)}
+
+    if needs_rehash(stored_hash):
+        try:
+            rehash_password(user_id=user_id, password=password, old_hash=stored_hash)
+
+        except HashQueueFull:
+            # the password is right; the hash is upgraded on a later login
+            logger.info("hash queue full, password hash of user %s kept", user_id)
 
-    return {"status": False, "error": "Invalid password"}
+    return {"status": True, "id": user_id}
+
+
+def rehash_password(*, user_id, password, old_hash):
+    """
+    Stores a new hash of password made with the current cost factor, unless
+    the password was changed in the meantime
+    """
+    hashed_password = hash_password(password)
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """UPDATE public.user SET password = %s
+                WHERE id = %s AND password = %s""",
+                (hashed_password, user_id, old_hash),
+            )
+            conn.commit()
+
+        except psycopg2.Error as err:
+            # the old hash still works, so the login goes ahead
+            logger.warning(
+                "could not upgrade password hash of user %s: %s", user_id, err
+            )
 
 
 def update_password(*, email, curr_password, new_password):
     """
     Autheticates user email with current password, and updates password with new password
     """
-    conn = get_connection()
-    cursor = conn.cursor()
 
     required_fields = ["email", "curr_password", "new_password"]
 
@@ -165,25 +224,34 @@ def update_password(*, email, curr_password, new_password):
 
     error = None
     flag = True
-    if authenticate(email=email, password=curr_password):
-        password = new_password.encode("utf-8")
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password, salt)
-
+    if authenticate(email=email, password=curr_password)["status"]:
         try:
-            cursor.execute(
-                """UPDATE public.user SET
-            password = %s WHERE email = %s AND is_active=True""",
-                (
-                    hashed_password,
-                    email,
-                ),
-            )
-            conn.commit()
-
-        except psycopg2.Error as err:
-            error = str(err)
-            flag = False
+            hashed_password = hash_password(new_password)
+
+        except HashQueueFull as err:
+            return {"status": False, "error": str(err)}
+
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    """UPDATE public.user SET
+                password = %s WHERE email = %s AND is_active=True RETURNING id""",
+                    (
+                        hashed_password,
+                        email,
+                    ),
+                )
+                updated = cursor.fetchall()
+                conn.commit()
+
+            except psycopg2.Error as err:
+                error = str(err)
+                flag = False
+
+            else:
+                for row in updated:
+                    token_cache.invalidate_user(row[0])
 
         return {"status": flag, "error": error}
 
@@ -194,8 +262,6 @@ def delete_user(*, user_id):
     """
     Authenticates user email and inactivates if authenticated
     """
-    conn = get_connection()
-    cursor = conn.cursor()
 
     error = None
     flag = True
@@ -208,16 +274,22 @@ def delete_user(*, user_id):
         error = str(ValueError("Fields with invalid data: user_id"))
         return {"status": False, "error": error}
 
-    try:
-        cursor.execute(
-            """UPDATE public.user SET
-        is_active = False  WHERE id=%s""",
-            (user_id,),
-        )
-        conn.commit()
-
-    except psycopg2.Error as err:
-        error = str(err)
-        flag = False
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """UPDATE public.user SET
+            is_active = False  WHERE id=%s""",
+                (user_id,),
+            )
+            conn.commit()
+
+        except psycopg2.Error as err:
+            error = str(err)
+            flag = False
+
+        else:
+            token_cache.invalidate_user(user_id)
+            table_versions.bump("user")
 
     return {"status": flag, "error": error}
@@ -0,0 +1,136 @@
+"""
+Counts the database work done by each request: connections checked out,
+statements executed, rows returned and time spent waiting on Postgres.
+
+Every cursor handed out by config.Connection records into the stats of
+the request running on its thread, so handlers that quietly fan out into
+extra connections and queries show up. Outside of a request nothing is
+recorded.
+"""
+import threading
+import time
+from collections import Counter
+
+# characters of a statement used to tell statements apart
+QUERY_TEXT_LENGTH = 200
+
+_local = threading.local()
+_cursor_classes = {}
+_cursor_classes_lock = threading.Lock()
+
+
+class RequestStats:
+    """Database work of one request"""
+
+    def __init__(self):
+        self.connections = 0
+        self.statements = 0
+        self.rows = 0
+        self.seconds = 0.0
+        # statements by their text, to find the ones run over and over
+        self.queries = Counter()
+
+    def repeated(self):
+        """
+        Returns the statement run most often and how many times, or
+        (None, 0) if no statement ran more than once, the mark of a handler
+        querying once per item
+        """
+        for query, count in self.queries.most_common(1):
+            if count > 1:
+                return query, count
+        return None, 0
+
+
+def start_request():
+    """Starts counting the database work of a request on the calling thread"""
+    _local.stats = RequestStats()
+
+
+def finish_request():
+    """
+    Stops counting on the calling thread and returns the stats of the
+    request, or None if none was started
+    """
+    stats = getattr(_local, "stats", None)
+    _local.stats = None
+    return stats
+
+
+def current():
+    """Returns the stats of the request on the calling thread, or None"""
+    return getattr(_local, "stats", None)
+
+
+def connection():
+    """Counts a connection checked out from the pool"""
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.connections += 1
+
+
+def _record(query, seconds, rows):
+    stats = getattr(_local, "stats", None)
+    if stats is None:
+        return
+
+    stats.statements += 1
+    stats.rows += rows
+    stats.seconds += seconds
+    # the query text before its parameters, cut short for statements such
+    # as execute_values pages that carry their values inline
+    if isinstance(query, bytes):
+        query = query[:QUERY_TEXT_LENGTH].decode("utf-8", "replace")
+    query = str(query)[:QUERY_TEXT_LENGTH]
+    stats.queries[" ".join(query.split())] += 1
+
+
+class CountingCursor:
+    """
+    Mixin for psycopg2 cursor classes that records every statement in the
+    stats of the current request
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+
+        finally:
+            rows = max(self.rowcount, 0) if self.description is not None else 0
+            _record(query, time.perf_counter() - start, rows)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+
+        finally:
+            _record(query, time.perf_counter() - start, 0)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+
+        finally:
+            _record(sql, time.perf_counter() - start, 0)
+
+
+def counting(cursor_class):
+    """
+    Returns a subclass of cursor_class whose statements are counted, made
+    once per cursor class
+    """
+    counted = _cursor_classes.get(cursor_class)
+    if counted is None:
+        with _cursor_classes_lock:
+            counted = _cursor_classes.setdefault(
+                cursor_class,
+                type(
+                    f"Counting{cursor_class.__name__}",
+                    (CountingCursor, cursor_class),
+                    {},
+                ),
+            )
+    return counted
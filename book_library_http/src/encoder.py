@@ -0,0 +1,36 @@
+"""
+Encodes response payloads as JSON in a single pass
+"""
+import datetime
+import decimal
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+
+def _default(value):
+    # types that the json encoders do not handle themselves
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_json(payload):
+    """
+    Returns payload encoded as UTF-8 JSON bytes. Decimal, datetime and date
+    values are encoded as numbers and ISO 8601 strings.
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+
+    return _encoder.encode(payload).encode("utf-8")
@@ -0,0 +1,124 @@
+"""
+Hashes and verifies passwords on a dedicated pool of worker processes, so
+that bcrypt does not hold up the threads serving requests.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+import bcrypt
+
+from config import BCRYPT_ROUNDS, HASH_QUEUE_DEPTH, HASH_WORKERS
+
+
+class HashQueueFull(Exception):
+    """Raised when too many passwords are already waiting to be hashed"""
+
+
+_executor = None
+_lock = threading.Lock()
+_in_flight = 0
+
+
+def _hash(password, rounds):
+    # runs in a worker process
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password, hashed):
+    # runs in a worker process
+    return bcrypt.checkpw(password, hashed)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn, so workers do not inherit the server's threads and sockets
+        _executor = ProcessPoolExecutor(
+            max_workers=HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def _done(_future):
+    global _in_flight
+    with _lock:
+        _in_flight -= 1
+
+
+def _run(function, *args):
+    """
+    Runs function on the hashing pool and waits for its result. Raises
+    HashQueueFull instead of queueing once HASH_QUEUE_DEPTH calls are waiting
+    for a free worker.
+    """
+    global _executor, _in_flight
+    with _lock:
+        if _in_flight >= HASH_WORKERS + HASH_QUEUE_DEPTH:
+            raise HashQueueFull("Server busy, please try again")
+
+        executor = _get_executor()
+        _in_flight += 1
+
+    try:
+        future = executor.submit(function, *args)
+
+    except BaseException:
+        _done(None)
+        raise
+
+    future.add_done_callback(_done)
+    try:
+        return future.result()
+
+    except BrokenProcessPool:
+        with _lock:
+            if _executor is executor:
+                _executor = None
+        raise
+
+
+def queue_depth():
+    """Returns the number of hashing calls running or waiting"""
+    return _in_flight
+
+
+def hash_password(password):
+    """
+    Returns the bcrypt hash of password using the configured cost factor
+    """
+    return _run(_hash, password.encode("utf-8"), BCRYPT_ROUNDS)
+
+
+def hash_many(passwords):
+    """
+    Returns the bcrypt hashes of passwords, in order. The passwords are
+    spread over every worker in chunks, so batch jobs keep all cores busy.
+    It is not bounded by HASH_QUEUE_DEPTH and is not meant for requests.
+    """
+    passwords = [password.encode("utf-8") for password in passwords]
+    chunksize = max(1, len(passwords) // (HASH_WORKERS * 4))
+    with _lock:
+        executor = _get_executor()
+    return list(
+        executor.map(_hash, passwords, repeat(BCRYPT_ROUNDS), chunksize=chunksize)
+    )
+
+
+def check_password(password, hashed):
+    """
+    Returns True if password matches the stored bcrypt hash
+    """
+    return _run(_check, password.encode("utf-8"), bytes(hashed))
+
+
+def needs_rehash(hashed):
+    """
+    Returns True if hashed was created with a different cost factor than
+    the configured one
+    """
+    rounds = bytes(hashed).split(b"$")[2]
+    return int(rounds) != BCRYPT_ROUNDS
@@ -0,0 +1,194 @@
+"""
+Structured logging for the server. Records are handed to a queue and
+written as JSON lines by a background thread, so logging never blocks a
+request on stdout.
+
+    LOG_LEVEL=INFO                              level of every logger
+    LOG_LEVELS=controllers=DEBUG,access=WARNING levels of single loggers
+    LOG_SAMPLE_RATE=0.1                         share of requests whose info
+                                                and debug records are kept
+
+Records carry the id of the request they belong to. Secrets are redacted
+and large values are summarised instead of written out.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+# records waiting to be written; further records are dropped and counted
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# longest string, and most list items or dict keys, written for one field
+LOG_MAX_FIELD = int(os.environ.get("LOG_MAX_FIELD", 200))
+
+REDACTED = "[redacted]"
+SECRET_FIELDS = {"token", "password", "authorization", "curr_password"}
+SECRET_FIELDS |= {"new_password", "hashed_password", "old_hash"}
+# bearer tokens and the uuid4 strings used as tokens
+SECRET_PATTERN = re.compile(
+    r"(?i)bearer\s+\S+|\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b"
+)
+
+# attributes every LogRecord has; anything else was passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None)))
+RECORD_ATTRIBUTES |= {"message", "asctime", "request_id", "sampled"}
+
+_request = threading.local()
+_listener = None
+
+
+def start_request(request_id=None):
+    """
+    Marks the start of a request on the calling thread and decides whether
+    its records are sampled. Returns the request id, generating one if the
+    given id is missing or malformed.
+    """
+    if not request_id or not re.fullmatch(r"[\w.-]{1,64}", request_id):
+        request_id = uuid.uuid4().hex[:16]
+    _request.id = request_id
+    _request.sampled = random.random() < LOG_SAMPLE_RATE
+    return request_id
+
+
+def end_request():
+    """Marks the end of the request on the calling thread"""
+    _request.id = None
+    _request.sampled = True
+
+
+def redact(text):
+    """Returns text with bearer tokens and uuid tokens removed"""
+    return SECRET_PATTERN.sub(REDACTED, text)
+
+
+def summarize(value, key=None):
+    """
+    Returns value in a form fit for a log line: secrets are redacted, long
+    strings are truncated, and large lists and dicts are summarised
+    """
+    if key is not None and str(key).lower() in SECRET_FIELDS:
+        return REDACTED
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+
+    if isinstance(value, str):
+        value = redact(value)
+        if len(value) > LOG_MAX_FIELD:
+            return f"{value[:LOG_MAX_FIELD]}... <{len(value)} chars>"
+        return value
+
+    if isinstance(value, dict):
+        items = list(value.items())
+        summary = {k: summarize(v, k) for k, v in items[: LOG_MAX_FIELD // 10]}
+        if len(items) > len(summary):
+            summary["..."] = f"<{len(items)} keys>"
+        return summary
+
+    if isinstance(value, (list, tuple, set)):
+        if len(value) > LOG_MAX_FIELD // 20:
+            return f"<{type(value).__name__} of {len(value)} items>"
+        return [summarize(item) for item in value]
+
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+
+    return summarize(str(value))
+
+
+class RequestFilter(logging.Filter):
+    """
+    Adds the current request id to records, and drops the info and debug
+    records of requests that were not sampled
+    """
+
+    def filter(self, record):
+        record.request_id = getattr(_request, "id", None)
+        if record.levelno < logging.WARNING:
+            return getattr(_request, "sampled", True)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = summarize(value, key)
+
+        if record.exc_info:
+            entry["exception"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that drops records instead of blocking when the queue is
+    full, counting how many were lost
+    """
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # records are formatted by the background thread, not the caller
+        return record
+
+
+def configure():
+    """
+    Routes every logger through the background queue. Safe to call again.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter())
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(RequestFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+    for setting in filter(None, LOG_LEVELS.split(",")):
+        name, _, level = setting.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+def shutdown():
+    """Writes out the queued records and stops the background thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
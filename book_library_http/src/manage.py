@@ -2,28 +2,57 @@
 Api handling and server management
 """
 
-from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hmac
+import inspect
+import logging
+from collections import OrderedDict
+from urllib.parse import urlencode, urlparse, parse_qs
 import json
+import selectors
+import socket
 import sys
 import os
+import threading
+import time
 
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
 sys.path.append(os.path.abspath("/src"))
-from controllers.token import insert_token, validate_token
+from cache import compressed_bodies, token_cache
+import changes
+from config import QUERY_BUDGET
+import dbstats
+from hashing import queue_depth
+import log
+import metrics
+from middleware import (
+    HTTPError,
+    authenticate,
+    compress,
+    conditional_get,
+    handle_errors,
+    time_request,
+)
+from router import MethodNotAllowed, NotFound, Response, Router, chain
+from controllers.token import insert_token
 from controllers.book import (
     retrieve_book,
     insert_book,
+    insert_books,
+    ndjson_rows,
+    csv_rows,
     update_book,
     delete_book,
     retrieve_book_by_author,
     retrieve_purchased,
+    search_books,
     update_book_author,
 )
 from controllers.user import (
     retrieve_user,
-    authenticate,
     insert_user,
     update_password,
     delete_user,
@@ -32,328 +61,859 @@ from controllers.reading import (
     retrieve_reading,
     insert_reading,
     retrieve_reading_by_author,
+    retrieve_engagement,
     book_completed,
 )
 from controllers.transaction import (
     retrieve_transaction,
     insert_transaction,
+    insert_transactions,
     retrieve_transaction_by_author,
+    retrieve_earnings,
 )
 
 BASE_DIR = os.getcwd()
 
+logger = logging.getLogger("manage")
+access_log = logging.getLogger("access")
 
-HOST = "127.0.0.1"
-PORT = 8000
 
+HOST = os.environ.get("HOST", "127.0.0.1")
+PORT = int(os.environ.get("PORT", 8000))
+# number of requests served at the same time
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 16))
+# connections the kernel queues while every worker is busy
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", 128))
+# seconds an idle keep-alive connection is held open
+KEEP_ALIVE_TIMEOUT = float(os.environ.get("KEEP_ALIVE_TIMEOUT", 5))
+# idle keep-alive connections held open at most; beyond that they are closed
+MAX_IDLE_CONNECTIONS = int(os.environ.get("MAX_IDLE_CONNECTIONS", 1024))
+# requests served on one connection before the server closes it
+KEEP_ALIVE_MAX_REQUESTS = int(os.environ.get("KEEP_ALIVE_MAX_REQUESTS", 100))
 
-class User:
-    """Defines User as an object"""
+# methods counted in the metrics, the rest are counted as "other"
+METHODS = {"GET", "POST", "PUT", "DELETE"}
+# when set, /metrics is only served to requests bearing this token
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# unread request bodies up to this size are skipped to keep the connection
+# alive, larger ones close it
+MAX_DISCARD = 64 * 1024
 
-    def __init__(self, user_id, user_type):
-        self.user_id = user_id
-        self.user_type = user_type
+# body formats accepted by /publish/bulk, by Content-Type
+BULK_FORMATS = {
+    "application/x-ndjson": ndjson_rows,
+    "application/jsonl": ndjson_rows,
+    "text/csv": csv_rows,
+}
 
+USERS = ("user",)
+ADMINS = ("admin",)
+EVERYONE = ("user", "admin")
 
-class APIHandle(BaseHTTPRequestHandler):
+ROUTER = Router()
+route = ROUTER.route
+
+
+@lru_cache(maxsize=None)
+def _signature(function):
+    return inspect.signature(function)
+
+
+def call(function, **fields):
     """
-    Handles all API requests in the server
+    Calls a controller with the fields of a request, answering 400 if they
+    do not fit its parameters
     """
+    try:
+        _signature(function).bind(**fields)
 
-    def auth(self):
-        token = self.headers.get("Authorization")
-
-        if token.startswith("Bearer"):
-            token = token.strip("Bearer ")
-            validate = validate_token(token=token)
-            if validate["validated"]:
-                validated_user = validate["user"]
-                self.user = User(
-                    validated_user["user_id"],
-                    "admin" if validated_user["is_admin"] else "user",
-                )
+    except TypeError as error:
+        raise HTTPError(400, str(error)) from None
+    return function(**fields)
 
-            else:
-                self.user = None
 
-        else:
-            self.user = None
+def read_body(request):
+    """Returns the JSON object sent as the request body"""
+    try:
+        data = request.read_json()
 
-    def send_error(self, code, message=None):
-        """
-        Sends error code and message in REST format
-        """
-        self.send_response(code)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
+    except ValueError:
+        raise HTTPError(400, "Body must be valid JSON") from None
 
-        if not message:
-            message = self.responses.get(code)[0]
-        error_response = {"error": {"code": code, "message": message}}
-        self.wfile.write(json.dumps(error_response).encode("utf-8"))
+    if not isinstance(data, dict):
+        raise HTTPError(400, "Body must be a JSON object")
+    return data
 
-    def do_GET(self):
-        """
-        Handles all GET requests in the server
-        """
-        # breakpoint()
-        self.auth()
 
-        # print(self.headers.get("User_Type"))
+def required(data, field):
+    """Returns field of a request body, answering 400 if it is missing"""
+    if field not in data:
+        raise HTTPError(400, f"{field} is required")
+    return data[field]
 
-        response_data = {"status": True, "error": None}
-        path = urlparse(self.path)
-        print(path.query)
 
-        user = self.user
-        if not user:
-            self.send_error(401)
-            self.end_headers()
+def query_int(request, name):
+    """Returns the integer query parameter name, or None if not given"""
+    value = request.query.get(name, [None])[0]
+    try:
+        return int(value) if value else None
 
-        query_params = parse_qs(path.query)
-        if query_params:
-            book_id = int(query_params.get("book_id", None)[0])
-
-        get_routes_admin = {"/user": retrieve_user, "/book": retrieve_book}
-
-        get_routes_user = {
-            "/user": [retrieve_user, False],
-            "/book": [retrieve_book, True],
-            "/published": [retrieve_book_by_author, True],
-            "/purchased": [retrieve_purchased, True],
-            "/transaction/user": [retrieve_transaction, False],
-            "/transaction/author": [retrieve_transaction_by_author, False],
-            "/reading/user": [retrieve_reading, False],
-            "/reading/author": [retrieve_reading_by_author, False],
-        }
-        if user.user_type == "admin":
-            function = get_routes_admin.get(path.path)
-            if function:
-                response_data = function()
-                print(response_data)
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer") from None
 
-            else:
-                self.send_error(404)
-                self.end_headers()
 
-        else:
-            function = get_routes_user.get(path.path)
+def page(request):
+    """Returns the limit and cursor of a list request"""
+    return {
+        "limit": query_int(request, "limit"),
+        "after": request.query.get("after", [None])[0],
+    }
 
-            if function[0]:
-                if function[1] and query_params:
-                    response_data = function[0](
-                        user_id=int(user.user_id), book_id=book_id
-                    )
 
-                else:
-                    response_data = function[0](user_id=int(user.user_id))
-            else:
-                self.send_error(404)
-                self.end_headers()
+def listing(request, response_data):
+    """
+    Returns the response to a GET, with a link to the next page if there is
+    one; 404 if nothing was found, or 400 with the error of the controller
+    """
+    if response_data["status"] is False:
+        code = 404 if response_data.get("not_found") else 400
+        return Response.error(code, response_data["error"])
 
-        if response_data["status"] is False:
-            self.send_error(404, response_data["error"])
+    headers = {}
+    if response_data.get("next"):
+        cursor = response_data["next"]
+        query = urlencode({**request.query, "after": [cursor]}, doseq=True)
+        next_url = request.url._replace(query=query).geturl()
+        headers = {"X-Next-Cursor": cursor, "Link": f'<{next_url}>; rel="next"'}
+    return Response.json(200, response_data["data"], headers)
 
-        else:
-            response = response_data["data"]
-            response = json.loads(response)
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode())
 
-    def do_POST(self):
-        """
-        Handles all the post requests in the server
-        """
+def result(response_data):
+    """
+    Returns the response to a change: its data, 204 No Content, or 400 with
+    the error of the controller
+    """
+    if response_data["status"] is False:
+        return Response.error(400, response_data["error"])
 
-        path = urlparse(self.path)
-        content_length = int(self.headers["Content-Length"])
-        post_data = self.rfile.read(content_length).decode("utf-8")
-        if post_data:
-            post_data = json.loads(post_data)
+    if "data" in response_data:
+        return Response.json(200, response_data["data"])
 
-        response_data = {"status": False, "error": None}
+    logger.debug("response", extra={"response": response_data})
+    return Response(204)
 
-        if len(post_data) > 1:
-            post_data = {**post_data}
 
-        if path.path == "/signup":
-            response_data = insert_user(**post_data)
-            if response_data["status"]:
-                self.send_response(204)
-                self.end_headers()
-            else:
-                self.send_error(400, response_data["error"])
-                self.end_headers()
-                return
+@route("GET", "/metrics")
+def get_metrics(request):
+    # only for callers presenting METRICS_TOKEN as a Bearer token, if set
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return Response.error(401)
+
+    body = metrics.render().encode("utf-8")
+    return Response(200, body, "text/plain; version=0.0.4; charset=utf-8")
 
-        elif path.path == "/login":
-            auth = insert_token(**post_data)
-            if auth["status"] is False:
-                self.send_error(401, auth["error"])
-                return
-            else:
-                print(auth["token"])
-                self.send_response(200)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps(auth).encode())
-                return
 
-        self.auth()
-        user = self.user
+@route("GET", "/user", roles=ADMINS, tables=("user",))
+def list_users(request):
+    return listing(request, retrieve_user(**page(request)))
 
-        if not user:
-            self.send_error(401)
-            self.end_headers()
 
-        if path.path == "/publish":
-            print(post_data)
-            if user.user_type == "admin":
-                response_data = insert_book(**post_data)
+@route("GET", "/user", roles=USERS, tables=("user",))
+def get_user(request):
+    return listing(
+        request, retrieve_user(user_id=int(request.user.user_id), **page(request))
+    )
 
-            else:
-                response_data = insert_book(**post_data, author_id=user.user_id)
 
-        elif path.path == "/purchase":
-            response_data = insert_transaction(user_id=user.user_id, **post_data)
+@route("GET", "/book", roles=ADMINS, tables=("book", "transactions"))
+def list_books(request):
+    return listing(request, retrieve_book(**page(request)))
+
+
+@route("GET", "/book", roles=USERS, tables=("book", "transactions"))
+def get_books(request):
+    return get_book(request, query_int(request, "book_id"))
 
-        elif path.path == "/reading":
-            book_id = post_data["book_id"]
-            response_data = insert_reading(book_id=book_id, user_id=user.user_id)
 
-        else:
-            self.send_error(404, "path not found")
-            self.end_headers()
+@route("GET", "/book/{book_id:int}", roles=USERS, tables=("book", "transactions"))
+def get_book(request, book_id):
+    return listing(
+        request,
+        retrieve_book(
+            user_id=int(request.user.user_id), book_id=book_id, **page(request)
+        ),
+    )
+
+
+@route("GET", "/book/search", roles=EVERYONE, tables=("book", "transactions"))
+def get_search(request):
+    user = request.user
+    return listing(
+        request,
+        search_books(
+            q=request.query.get("q", [None])[0],
+            user_id=None if user.user_type == "admin" else int(user.user_id),
+            **page(request),
+        ),
+    )
+
 
-        if response_data["status"] is False:
-            self.send_error(400, response_data["error"])
-            self.end_headers()
+@route("GET", "/published", roles=USERS, tables=("book",))
+def get_published(request):
+    return listing(
+        request,
+        retrieve_book_by_author(
+            user_id=int(request.user.user_id),
+            book_id=query_int(request, "book_id"),
+            **page(request),
+        ),
+    )
 
-        elif "data" in response_data.keys():
-            self.send_response(200)
-            response = response_data["data"]
-            response = json.loads(response)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            print(response_data)
-            self.wfile.write(json.dumps(response).encode("utf-8"))
 
-        else:
-            self.send_response(204)
+@route("GET", "/purchased", roles=USERS, tables=("book", "transactions", "reading"))
+def get_purchased(request):
+    return listing(
+        request,
+        retrieve_purchased(user_id=int(request.user.user_id), **page(request)),
+    )
 
-            self.end_headers()
-            print(response_data)
 
-    def do_PUT(self):
-        """
-        Handles all the PUT requests in the server.
-        """
-        self.auth()
-        user = self.user
+@route("GET", "/transaction/user", roles=USERS, tables=("transactions",))
+def get_transactions(request):
+    return listing(
+        request,
+        retrieve_transaction(user_id=int(request.user.user_id), **page(request)),
+    )
 
-        if not user:
-            self.send_error(401)
-            self.end_headers()
 
-        path = urlparse(self.path)
-        content_length = int(self.headers["Content-Length"])
-        post_data = self.rfile.read(content_length).decode("utf-8")
-        post_data = json.loads(post_data)
+@route("GET", "/transaction/author", roles=USERS, tables=("transactions", "book"))
+def get_sales(request):
+    return listing(
+        request,
+        retrieve_transaction_by_author(
+            user_id=int(request.user.user_id), **page(request)
+        ),
+    )
 
-        response_data = {"status": False, "error": None}
-        user = self.user
 
-        put_requests = {
-            "/user": update_password,
-            "/book": update_book_author,
-            "/completed": book_completed,
-        }
+@route("GET", "/earnings", roles=USERS, tables=("transactions", "book"))
+def get_earnings(request):
+    return listing(
+        request,
+        retrieve_earnings(
+            user_id=int(request.user.user_id), book_id=query_int(request, "book_id")
+        ),
+    )
 
-        if user.user_type == "user":
-            if path.path == "/user":
-                function = put_requests.get(path.path)
-                response_data = function(**post_data)
 
-            else:
-                function = put_requests.get(path.path)
+@route("GET", "/reading/user", roles=USERS, tables=("reading",))
+def get_reading(request):
+    return listing(
+        request,
+        retrieve_reading(user_id=int(request.user.user_id), **page(request)),
+    )
 
-                if function:
-                    if path.path == "/user":
-                        response_data = function(user_id=user.user_id, **post_data)
 
-                    elif path.path == "/completed":
-                        response_data = function(
-                            user_id=user.user_id, book_id=post_data["book_id"]
-                        )
+@route("GET", "/reading/author", roles=USERS, tables=("reading", "book"))
+def get_readers(request):
+    return listing(
+        request,
+        retrieve_reading_by_author(user_id=int(request.user.user_id), **page(request)),
+    )
+
+
+@route("GET", "/engagement", roles=USERS, tables=("reading", "book"), daily=True)
+def get_engagement(request):
+    return listing(
+        request,
+        retrieve_engagement(
+            user_id=int(request.user.user_id),
+            days=query_int(request, "days"),
+            **page(request),
+        ),
+    )
+
+
+@route("POST", "/signup")
+def signup(request):
+    return result(call(insert_user, **read_body(request)))
+
+
+@route("POST", "/login")
+def login(request):
+    auth = call(insert_token, **read_body(request))
+    if auth["status"] is False:
+        return Response.error(401, auth["error"])
+    return Response.json(200, auth)
+
+
+@route("POST", "/publish", roles=ADMINS)
+def publish_any(request):
+    return result(call(insert_book, **read_body(request)))
+
+
+@route("POST", "/publish", roles=USERS)
+def publish(request):
+    book = read_body(request)
+    logger.debug("publishing book", extra={"book": book})
+    return result(call(insert_book, **{**book, "author_id": request.user.user_id}))
+
+
+@route("POST", "/publish/bulk", roles=EVERYONE)
+def publish_bulk(request):
+    """
+    Publishes every book of an NDJSON or CSV body in one transaction. The
+    body is validated while it is read, and rejected rows are reported by
+    line. Users publish as themselves; admins may set author_id per row.
+    """
+    parse_rows = BULK_FORMATS.get(request.headers.get_content_type())
+    if not parse_rows:
+        return Response.error(415, "Body must be NDJSON or CSV")
+
+    user = request.user
+    author_id = None if user.user_type == "admin" else user.user_id
+    try:
+        response_data = insert_books(
+            rows=parse_rows(request.body_lines()), author_id=author_id
+        )
 
-                else:
-                    self.send_error(401)
+    except socket.timeout:
+        # the rest of the body cannot be skipped
+        request.unread = 0
+        request.close_connection = True
+        raise HTTPError(408, "Request body timed out") from None
+    return result(response_data)
 
-        else:
-            if path.path == "/book":
-                response_data = update_book(**post_data)
 
-            else:
-                self.send_error(401)
+@route("POST", "/purchase", roles=EVERYONE)
+def purchase(request):
+    order = read_body(request)
+    if "items" in order:
+        return result(
+            insert_transactions(user_id=request.user.user_id, items=order["items"])
+        )
+    order = {**order, "user_id": request.user.user_id}
+    return result(call(insert_transaction, **order))
+
+
+@route("POST", "/reading", roles=EVERYONE)
+def start_reading(request):
+    book_id = required(read_body(request), "book_id")
+    return result(insert_reading(book_id=book_id, user_id=request.user.user_id))
+
+
+@route("PUT", "/user", roles=USERS)
+def change_password(request):
+    return result(call(update_password, **read_body(request)))
+
+
+@route("PUT", "/book", roles=ADMINS)
+def change_book(request):
+    return result(call(update_book, **read_body(request)))
+
+
+@route("PUT", "/book/{book_id:int}", roles=ADMINS)
+def change_book_by_id(request, book_id):
+    return result(call(update_book, **{**read_body(request), "book_id": book_id}))
+
+
+@route("PUT", "/book", roles=USERS)
+def change_price(request):
+    changes = {**read_body(request), "user_id": request.user.user_id}
+    return result(call(update_book_author, **changes))
+
+
+@route("PUT", "/book/{book_id:int}", roles=USERS)
+def change_price_by_id(request, book_id):
+    changes = {**read_body(request), "user_id": request.user.user_id}
+    return result(call(update_book_author, **{**changes, "book_id": book_id}))
+
+
+@route("PUT", "/completed", roles=USERS)
+def complete_book(request):
+    book_id = required(read_body(request), "book_id")
+    return result(book_completed(user_id=request.user.user_id, book_id=book_id))
+
+
+@route("DELETE", "/book", roles=USERS)
+def remove_book(request):
+    return remove_book_by_id(request, required(read_body(request), "book_id"))
 
-        print(response_data.items())
 
-        if response_data["status"] is False:
-            self.send_error(400, response_data["error"])
+@route("DELETE", "/book/{book_id:int}", roles=USERS)
+def remove_book_by_id(request, book_id):
+    logger.debug("deleting book", extra={"book_id": book_id})
+    return result(delete_book(user_id=request.user.user_id, book_id=book_id))
 
-        else:
-            self.send_response(204)
+
+@route("DELETE", "/user", roles=ADMINS)
+def remove_user(request):
+    return remove_user_by_id(request, required(read_body(request), "user_id"))
+
+
+@route("DELETE", "/user/{user_id:int}", roles=ADMINS)
+def remove_user_by_id(request, user_id):
+    return result(delete_user(user_id=user_id))
+
+
+def endpoint(request):
+    """Calls the handler of the route for the role of the user"""
+    if request.route is None:
+        raise request.routing_error
+
+    user = request.user
+    handler = request.route.handlers[user.user_type if user else None]
+    return handler(request, **request.params)
+
+
+# outermost first; the ETag of conditional_get covers the user, so it runs
+# after authenticate
+MIDDLEWARE = [handle_errors, time_request, compress, authenticate, conditional_get]
+APP = chain(MIDDLEWARE, endpoint)
+
+
+class APIHandle(BaseHTTPRequestHandler):
+    """
+    Handles all API requests in the server. Requests are routed by ROUTER
+    and answered by APP. Connections are kept alive between requests until
+    they idle for KEEP_ALIVE_TIMEOUT seconds or have served
+    KEEP_ALIVE_MAX_REQUESTS requests. Between requests they wait in the
+    server's idle set, not on the worker.
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def handle(self):
+        self.requests_served = self.server.requests_served(self.request)
+        self.idle = False
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.request_buffered():
+                # the worker is handed back until the next request arrives
+                self.idle = True
+                return
+            self.handle_one_request()
+
+    def request_buffered(self):
+        """
+        Returns whether the next request has already been received, as when
+        requests are pipelined, without waiting for it
+        """
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+
+        except OSError:
+            self.close_connection = True
+            return False
+
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        self.status_code = None
+        self.request_start = None
+        self.request_id = None
+        self.route = None
+        try:
+            super().handle_one_request()
+
+        finally:
+            route = self.route.pattern if self.route else "other"
+            method = getattr(self, "command", None)
+            metrics.finish_request(
+                route,
+                method if method in METHODS else "other",
+                self.status_code or "aborted",
+            )
+            self.check_query_budget(route, dbstats.finish_request())
+            if self.request_start is not None:
+                self.log_access(urlparse(getattr(self, "path", "")).path)
+
+    def parse_request(self):
+        # the request line has been read, so the request starts here
+        metrics.start_request()
+        dbstats.start_request()
+        self.request_start = time.perf_counter()
+        parsed = super().parse_request()
+        self.request_id = log.start_request(
+            self.headers.get("X-Request-ID") if parsed else None
+        )
+        return parsed
+
+    def check_query_budget(self, route, stats):
+        """
+        Counts the database work of the request that was just served, and
+        warns if it executed more than QUERY_BUDGET statements
+        """
+        if stats is None:
+            return
+
+        labels = (("route", route),)
+        metrics.inc("db_connections_total", labels, stats.connections)
+        metrics.inc("db_statements_total", labels, stats.statements)
+        metrics.inc("db_rows_total", labels, stats.rows)
+        if stats.statements <= QUERY_BUDGET:
+            return
+
+        metrics.inc("db_query_budget_exceeded_total", labels)
+        query, count = stats.repeated()
+        logger.warning(
+            "%s %s executed %d statements, over the budget of %d",
+            self.command,
+            route,
+            stats.statements,
+            QUERY_BUDGET,
+            extra={
+                "connections": stats.connections,
+                "statements": stats.statements,
+                "rows": stats.rows,
+                "db_ms": round(stats.seconds * 1000, 3),
+                "repeated_query": query,
+                "repeated_count": count,
+            },
+        )
+
+    def log_access(self, route):
+        """
+        Logs the request that was just served, and ends it
+        """
+        duration = time.perf_counter() - self.request_start
+        access_log.info(
+            "%s %s %s",
+            self.command,
+            route,
+            self.status_code,
+            extra={
+                "method": self.command,
+                "path": route,
+                "status": self.status_code,
+                "duration_ms": round(duration * 1000, 3),
+                "client": self.client_address[0],
+            },
+        )
+        log.end_request()
+
+    def log_request(self, code="-", size="-"):
+        # requests are logged by log_access once they are finished
+        pass
+
+    def log_message(self, format, *args):
+        logger.warning(format, *args, extra={"client": self.client_address[0]})
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.status_code = code
+        if getattr(self, "request_id", None):
+            self.send_header("X-Request-ID", self.request_id)
+        self.requests_served += 1
+        if self.requests_served >= KEEP_ALIVE_MAX_REQUESTS:
+            self.close_connection = True
+
+        if self.close_connection:
+            self.send_header("Connection", "close")
+
+    def send_error(self, code, message=None, explain=None):
+        """
+        Sends error code and message in REST format. Only used for requests
+        BaseHTTPRequestHandler rejects itself, whose unread bytes cannot be
+        trusted to start the next request, so the connection is closed.
+        """
+        self.close_connection = True
+        self.write_response(Response.error(code, message))
+
+    def write_response(self, response):
+        """
+        Writes response with its Content-Type and Content-Length
+        """
+        self.send_response(response.status)
+        if response.content_type:
+            self.send_header("Content-type", response.content_type)
+        if response.status not in (204, 304):
+            self.send_header("Content-Length", str(len(response.body)))
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        with metrics.phase("write"):
             self.end_headers()
-            print(response_data)
+            if response.body:
+                self.wfile.write(response.body)
 
-    def do_DELETE(self):
+    def dispatch(self):
         """
-        Handles all the DELETE requests in the server.
+        Routes the request, runs it through the middleware and writes the
+        response
         """
+        self.url = urlparse(self.path)
+        self.query = parse_qs(self.url.query)
+        self.unread = self.body_length()
+        self.params = {}
+        self.routing_error = None
+        try:
+            self.route, self.params = ROUTER.match(self.command, self.url.path)
 
-        path = urlparse(self.path)
-        content_length = int(self.headers["Content-Length"])
-        post_data = self.rfile.read(content_length).decode("utf-8")
-        post_data = json.loads(post_data)
+        except (NotFound, MethodNotAllowed) as error:
+            self.routing_error = error
 
-        self.auth()
-        user = self.user
+        response = APP(self)
+        self.discard_body()
+        self.write_response(response)
 
-        if not user:
-            self.send_error(401)
-            self.end_headers()
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+    def body_length(self):
+        """
+        Returns the length of the request body. A body that is not framed by
+        a valid Content-Length cannot be skipped, so the connection is closed
+        after the response instead.
+        """
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
 
-        if user.user_type == "user":
-            if path.path == "/book":
-                print(post_data)
+        except ValueError:
+            length = -1
 
-                response_data = delete_book(
-                    user_id=user.user_id, book_id=post_data["book_id"]
-                )
+        if length < 0 or "Transfer-Encoding" in self.headers:
+            self.close_connection = True
+            return 0
+        return length
 
-            else:
-                self.send_error(401)
+    def read_json(self):
+        """
+        Reads the whole request body and returns it decoded from JSON, or an
+        empty dict if there is none. Raises ValueError for invalid JSON.
+        """
+        body = self.rfile.read(self.unread) if self.unread else b""
+        self.unread = 0
+        if not body.strip():
+            return {}
+        return json.loads(body)
 
-        else:
-            if path.path == "/user":
-                response_data = delete_user(user_id=post_data["user_id"])
+    def body_lines(self):
+        """
+        Yields the request body line by line as it is read from the socket
+        """
+        while self.unread > 0:
+            line = self.rfile.readline(self.unread)
+            if not line:
+                self.unread = 0
+                break
+            self.unread -= len(line)
+            yield line
+
+    def discard_body(self):
+        """
+        Skips what the handler left unread of the request body, or closes
+        the connection after the response if that is more than MAX_DISCARD
+        """
+        if self.unread > MAX_DISCARD:
+            self.close_connection = True
+
+        elif self.unread:
+            self.rfile.read(self.unread)
+        self.unread = 0
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP server that hands every accepted connection to a bounded pool of
+    worker threads. Once all workers are busy the server stops accepting, so
+    further clients wait in the listen backlog instead of piling up in memory.
+    A kept alive connection only holds a worker while it is served: between
+    requests it waits on a selector of the idle thread, which hands it to a
+    worker again when the next request arrives, and closes it after
+    KEEP_ALIVE_TIMEOUT seconds.
+    """
+
+    def __init__(self, server_address, handler_class, *, workers, backlog):
+        self.request_queue_size = backlog
+        self._workers = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="http-worker"
+        )
+        self._free_workers = threading.BoundedSemaphore(workers)
+        # requests served so far on the connections handed back to a worker
+        self._served = {}
+        # connections parked by workers, registered by the idle thread
+        self._parked = []
+        self._parked_lock = threading.Lock()
+        self._wakeup, self._wake = socket.socketpair()
+        self._closing = False
+        super().__init__(server_address, handler_class)
+        self._idle_thread = threading.Thread(
+            target=self._wait_idle, name="http-idle", daemon=True
+        )
+        self._idle_thread.start()
+
+    def get_request(self):
+        conn, client_address = super().get_request()
+        # responses are written in one go, so there is nothing to coalesce
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn, client_address
+
+    def process_request(self, request, client_address):
+        self._free_workers.acquire()
+        try:
+            self._workers.submit(self._process_request, request, client_address)
+
+        except RuntimeError:
+            self._free_workers.release()
+            self.shutdown_request(request)
+
+    def _process_request(self, request, client_address):
+        # runs on a worker thread
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+
+        except Exception:
+            self.handle_error(request, client_address)
+
+        finally:
+            if handler is not None and handler.idle:
+                self.park(request, client_address, handler.requests_served)
 
             else:
-                self.send_error(401)
+                self.shutdown_request(request)
+            self._free_workers.release()
+
+    def requests_served(self, request):
+        """Returns the requests served on a connection before it idled"""
+        return self._served.pop(request, 0)
+
+    def park(self, request, client_address, requests_served):
+        """Hands an idle connection to the idle thread"""
+        with self._parked_lock:
+            self._parked.append((request, client_address, requests_served))
+        self._wake.send(b"\0")
+
+    def _wait_idle(self):
+        # runs on the idle thread, which alone uses the selector
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup, selectors.EVENT_READ)
+        deadlines = OrderedDict()
+        while not self._closing:
+            timeout = None
+            if deadlines:
+                first = next(iter(deadlines.values()))
+                timeout = max(0, first - time.monotonic())
+
+            for key, _ in selector.select(timeout):
+                if key.fileobj is self._wakeup:
+                    self._wakeup.recv(4096)
+                    continue
+
+                # the next request has arrived
+                selector.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                self._resume(key.fileobj, *key.data)
+
+            with self._parked_lock:
+                parked, self._parked = self._parked, []
+            for request, client_address, requests_served in parked:
+                if len(deadlines) >= MAX_IDLE_CONNECTIONS:
+                    self.shutdown_request(request)
+                    continue
+
+                selector.register(
+                    request, selectors.EVENT_READ, (client_address, requests_served)
+                )
+                deadlines[request] = time.monotonic() + KEEP_ALIVE_TIMEOUT
+
+            now = time.monotonic()
+            while deadlines and next(iter(deadlines.values())) <= now:
+                request, _ = deadlines.popitem(last=False)
+                selector.unregister(request)
+                self.shutdown_request(request)
+
+        for request in deadlines:
+            self.shutdown_request(request)
+        selector.close()
+
+    def _resume(self, request, client_address, requests_served):
+        # waits for a free worker, as accepting a connection does
+        self._free_workers.acquire()
+        self._served[request] = requests_served
+        try:
+            self._workers.submit(self._process_request, request, client_address)
+
+        except RuntimeError:
+            self._served.pop(request, None)
+            self._free_workers.release()
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._closing = True
+        self._wake.send(b"\0")
+        self._idle_thread.join()
+        self._workers.shutdown(wait=True)
+        with self._parked_lock:
+            for request, _, _ in self._parked:
+                self.shutdown_request(request)
+            self._parked = []
+        self._wake.close()
+        self._wakeup.close()
+
+
+metrics.register(
+    "hash_queue_depth", "gauge", "Password hashes running or waiting", queue_depth
+)
+metrics.register(
+    "token_cache_hits_total",
+    "counter",
+    "Tokens validated from the cache",
+    lambda: token_cache.stats()["hits"],
+)
+metrics.register(
+    "token_cache_misses_total",
+    "counter",
+    "Tokens validated against the database",
+    lambda: token_cache.stats()["misses"],
+)
+
+metrics.register(
+    "compressed_bodies_hits_total",
+    "counter",
+    "Response bodies compressed earlier and served from the cache",
+    lambda: compressed_bodies.stats()["hits"],
+)
+metrics.register(
+    "compressed_bodies_misses_total",
+    "counter",
+    "Cacheable response bodies that had to be compressed",
+    lambda: compressed_bodies.stats()["misses"],
+)
 
-        if response_data["status"] is False:
-            self.send_error(400, response_data["error"])
 
-        else:
-            self.send_response(204)
-            self.end_headers()
-            print(response_data)
+metrics.register(
+    "log_records_dropped_total",
+    "counter",
+    "Log records dropped because the log queue was full",
+    lambda: log.DroppingQueueHandler.dropped,
+)
+
+
+def main():
+    server = PooledHTTPServer(
+        (HOST, PORT), APIHandle, workers=WORKER_THREADS, backlog=LISTEN_BACKLOG
+    )
+    log.configure()
+    changes.start()
+    logger.info("serving on %s:%d", HOST, PORT)
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+        logger.info("server closed")
+        log.shutdown()
 
 
-server = HTTPServer((HOST, PORT), APIHandle)
-print("serve now")
-server.serve_forever()
-server.server_close()
-print("server close")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Request metrics, exposed in the Prometheus text format by /metrics.
+
+Every thread records into its own shard, so recording takes no lock; the
+shards are only summed when the metrics are rendered. The time of a request
+is split into phases that do not overlap: a phase started inside another,
+such as the database time of authentication, is not counted twice.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+METRICS = {
+    "http_requests_total": ("counter", "HTTP requests served"),
+    "http_requests_in_flight": ("gauge", "HTTP requests being served"),
+    "http_request_duration_seconds": (
+        "histogram",
+        "Time from reading the request line to writing the response",
+    ),
+    "http_request_phase_seconds": (
+        "histogram",
+        "Request time spent in auth, db, pool_wait, serialize, compress, write "
+        "and other",
+    ),
+    "db_pool_wait_seconds": (
+        "histogram",
+        "Time spent waiting for a pooled database connection",
+    ),
+    "db_connections_total": ("counter", "Database connections checked out"),
+    "db_statements_total": ("counter", "Database statements executed"),
+    "db_rows_total": ("counter", "Rows returned by database statements"),
+    "db_query_budget_exceeded_total": (
+        "counter",
+        "Requests that executed more statements than QUERY_BUDGET",
+    ),
+}
+
+_shards = []
+_shards_lock = threading.Lock()
+_local = threading.local()
+_callbacks = {}
+
+
+def _shard():
+    # the calling thread's counters and histograms, created on first use
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = ({}, {})
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def inc(name, labels=(), amount=1):
+    """
+    Adds amount to the counter or gauge name with labels, a tuple of
+    (label, value) pairs
+    """
+    counters = _shard()[0]
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, labels, value):
+    """
+    Records value in the histogram name with labels
+    """
+    histograms = _shard()[1]
+    key = (name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+    histogram[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+    histogram[1] += value
+
+
+def register(name, kind, help_text, callback):
+    """
+    Adds a metric whose value is read from callback when rendering
+    """
+    _callbacks[name] = (kind, help_text, callback)
+
+
+@contextmanager
+def phase(name):
+    """
+    Counts the time spent in the block towards phase name of the current
+    request. Outside of a request it does nothing.
+    """
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        yield
+        return
+
+    frame = [name, 0.0]
+    frames.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+
+    finally:
+        elapsed = time.perf_counter() - start
+        frames.pop()
+        # time of nested phases is counted by those phases
+        _local.phases[name] = _local.phases.get(name, 0.0) + elapsed - frame[1]
+        frames[-1][1] += elapsed
+
+
+def start_request():
+    """Starts timing a request on the calling thread"""
+    _local.frames = [["other", 0.0]]
+    _local.phases = {}
+    _local.start = time.perf_counter()
+    inc("http_requests_in_flight")
+
+
+def finish_request(route, method, status):
+    """
+    Records the request started on the calling thread by start_request
+    """
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        return
+
+    duration = time.perf_counter() - _local.start
+    _local.frames = None
+    phases = _local.phases
+    phases["other"] = duration - frames[0][1]
+
+    inc("http_requests_in_flight", amount=-1)
+    inc(
+        "http_requests_total",
+        (("route", route), ("method", method), ("status", str(status))),
+    )
+    observe(
+        "http_request_duration_seconds",
+        (("route", route), ("method", method)),
+        duration,
+    )
+    for name, seconds in phases.items():
+        observe(
+            "http_request_phase_seconds", (("route", route), ("phase", name)), seconds
+        )
+
+
+def _labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (
+        (label, value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for label, value in pairs
+    )
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format
+    """
+    counters = {}
+    histograms = {}
+    with _shards_lock:
+        shards = list(_shards)
+
+    for shard_counters, shard_histograms in shards:
+        for key, value in shard_counters.copy().items():
+            counters[key] = counters.get(key, 0) + value
+
+        for key, (buckets, total) in shard_histograms.copy().items():
+            merged = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+            for index, count in enumerate(list(buckets)):
+                merged[0][index] += count
+            merged[1] += total
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind != "histogram":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            continue
+
+        for (metric, labels), (buckets, total) in sorted(histograms.items()):
+            if metric != name:
+                continue
+
+            cumulative = 0
+            for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), buckets):
+                cumulative += count
+                le = _labels(labels, (("le", str(bound)),))
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+    for name, (kind, help_text, callback) in _callbacks.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {callback()}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,196 @@
+"""
+Middleware run around every routed request, composed by router.chain in
+the order of manage.MIDDLEWARE. Each is called with the request handler and
+the next middleware, and returns the Response.
+"""
+import hashlib
+import logging
+import time
+from datetime import date
+
+import compression
+import dbstats
+import metrics
+from cache import compressed_bodies, table_versions
+from config import COMPRESS_MIN_SIZE, DEBUG
+from controllers.token import validate_token
+from router import MethodNotAllowed, NotFound, Response
+
+logger = logging.getLogger(__name__)
+
+# types of body that compress well
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+class HTTPError(Exception):
+    """Ends a request with status and message, sent as a REST error"""
+
+    def __init__(self, status, message=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class User:
+    """Defines User as an object"""
+
+    def __init__(self, user_id, user_type):
+        self.user_id = user_id
+        self.user_type = user_type
+
+
+def handle_errors(request, call_next):
+    """
+    Turns routing errors, HTTPError and unexpected exceptions into REST
+    errors
+    """
+    try:
+        return call_next(request)
+
+    except NotFound:
+        return Response.error(404, "path not found")
+
+    except MethodNotAllowed as error:
+        return Response.error(405, headers={"Allow": ", ".join(error.allowed)})
+
+    except HTTPError as error:
+        return Response.error(error.status, error.message)
+
+    except Exception:
+        logger.exception("unhandled error")
+        request.close_connection = True
+        return Response.error(500)
+
+
+def time_request(request, call_next):
+    """
+    In DEBUG mode sends the time spent in the handler and the database work
+    of the request as Server-Timing and X-DB-* headers
+    """
+    if not DEBUG:
+        return call_next(request)
+
+    start = time.perf_counter()
+    response = call_next(request)
+    app_ms = (time.perf_counter() - start) * 1000
+
+    stats = dbstats.current()
+    if stats is None:
+        response.headers["Server-Timing"] = f"app;dur={app_ms:.3f}"
+        return response
+
+    db_ms = stats.seconds * 1000
+    db_timing = f'db;dur={db_ms:.3f};desc="{stats.statements} queries"'
+    response.headers["Server-Timing"] = f"app;dur={app_ms:.3f}, {db_timing}"
+    response.headers["X-DB-Connections"] = str(stats.connections)
+    response.headers["X-DB-Queries"] = str(stats.statements)
+    response.headers["X-DB-Rows"] = str(stats.rows)
+    response.headers["X-DB-Time"] = f"{db_ms:.3f}"
+    return response
+
+
+def compress(request, call_next):
+    """
+    Compresses text and JSON bodies of at least COMPRESS_MIN_SIZE bytes with
+    the encoding the client prefers. Bodies of responses with an ETag are
+    cached compressed by a digest of their content, so a page that is served
+    again unchanged is compressed only once; their tag is sent weak, as it
+    now names the same content in another encoding.
+    """
+    response = call_next(request)
+    content_type = response.content_type or ""
+    if (
+        len(response.body) < COMPRESS_MIN_SIZE
+        or not content_type.startswith(COMPRESSIBLE_TYPES)
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.headers["Vary"] = "Accept-Encoding"
+    encoding = compression.negotiate(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
+
+    etag = response.headers.get("ETag")
+    key = None
+    if etag:
+        # the ETag is made before the handler runs and may not match the body
+        key = (hashlib.blake2b(response.body, digest_size=16).digest(), encoding)
+    body = compressed_bodies.get(key) if key else None
+    if body is None:
+        with metrics.phase("compress"):
+            body = compression.compress(response.body, encoding)
+        if key:
+            compressed_bodies.set(key, body)
+
+    response.body = body
+    response.headers["Content-Encoding"] = encoding
+    if etag and not etag.startswith("W/"):
+        response.headers["ETag"] = f"W/{etag}"
+    return response
+
+
+def authenticate(request, call_next):
+    """
+    Resolves the user of the Bearer token of a guarded route, answering 401
+    without a valid token and 403 if the user's role may not use the route
+    """
+    request.user = None
+    route = request.route
+    if route is None or route.public:
+        return call_next(request)
+
+    token = request.headers.get("Authorization", "")
+    if token.startswith("Bearer "):
+        with metrics.phase("auth"):
+            validate = validate_token(token=token[len("Bearer ") :])
+        if validate.get("validated"):
+            validated_user = validate["user"]
+            request.user = User(
+                validated_user["user_id"],
+                "admin" if validated_user["is_admin"] else "user",
+            )
+
+    if request.user is None:
+        return Response.error(401)
+
+    if request.user.user_type not in route.handlers:
+        return Response.error(403)
+    return call_next(request)
+
+
+def conditional_get(request, call_next):
+    """
+    Answers a GET of a route that declares its tables with 304 Not Modified,
+    before any query runs, if the client already holds its ETag. The tag
+    covers the versions of the tables the route reads, the user and the
+    request target, and the date for a daily route. It is weak, as the body
+    may be sent compressed, and the 304 carries the same tag and Vary as
+    the 200, whichever encoding the client asks for.
+    """
+    route = request.route
+    user = request.user
+    if request.command != "GET" or user is None or not route.tables:
+        return call_next(request)
+
+    versions = table_versions.get(*route.tables)
+    key = f"{user.user_id}:{user.user_type}:{request.path}:{versions}"
+    if route.daily:
+        key += f":{date.today().isoformat()}"
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+    opaque = f'"{table_versions.boot}-{digest}"'
+    headers = {
+        "ETag": f"W/{opaque}",
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+    tags = request.headers.get("If-None-Match", "").split(",")
+    tags = {tag.strip().removeprefix("W/") for tag in tags}
+    if opaque in tags or "*" in tags:
+        return Response(304, headers=headers)
+
+    response = call_next(request)
+    if response.status == 200:
+        response.headers.update(headers)
+    return response
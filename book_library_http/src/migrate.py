@@ -0,0 +1,267 @@
+"""
+Applies the versioned schema migrations in migrations/ and checks that the
+controller queries are served by indexes.
+
+    python migrate.py            applies pending migrations
+    python migrate.py --status   lists applied and pending migrations
+    python migrate.py --check    EXPLAINs the controller queries
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from datetime import date, datetime
+
+from config import get_connection
+from controllers import book, reading, transaction, user
+import statements
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# serialises concurrent runners, e.g. several servers starting at once
+LOCK_ID = 4_716_001
+
+INDEX_SCANS = ("Index Scan", "Index Only Scan", "Bitmap Index Scan")
+PLANNER_SETTINGS = (
+    "enable_seqscan",
+    "enable_hashjoin",
+    "enable_mergejoin",
+    "enable_material",
+)
+
+# sample parameters of the prepared statements in statements.STATEMENTS
+STATEMENT_PARAMS = {
+    "validate_token": ("token", datetime(2024, 1, 1)),
+    "authenticate": ("reader@example.com",),
+    "book_by_id": (1,),
+    "transactions_by_user": (1, 0, 101),
+    "transactions_by_user_book": (1, 1, 0, 101),
+}
+
+# the other queries of the controllers and sample parameters
+QUERIES = {
+    "retrieve_user": (user.LIST_USERS, (0, 101)),
+    "retrieve_user by id": (user.USER_BY_ID, (1, 0, 101)),
+    "retrieve_book": (book.CATALOG, (0, 101)),
+    "retrieve_book for a user": (book.USER_CATALOG, (1, 1, 1, 0, 101)),
+    "retrieve_book_by_author": (book.BOOKS_BY_AUTHOR, (1, 0, 101)),
+    "retrieve_book_by_author by id": (book.BOOK_BY_AUTHOR, (1, 1, 0, 101)),
+    "retrieve_purchased": (book.PURCHASED, (1, 1, 0, 101)),
+    "search_books": (
+        book.SEARCH_BOOKS,
+        {
+            "terms": "harry:* & pott:*",
+            "name": "harry pott",
+            "user_id": 1,
+            "rank": 0.1,
+            "after_id": 1,
+            "limit": 101,
+        },
+    ),
+    "insert_transaction": (
+        transaction.PURCHASE_BOOK,
+        (1, 5.0, datetime(2024, 1, 1), 1, 1),
+    ),
+    "insert_transactions": (
+        transaction.PURCHASE_BOOKS,
+        (1, datetime(2024, 1, 1), [1, 2], [5.0, 5.0], 1),
+    ),
+    "purchase_error": (transaction.BOOK_STATUS, (1,)),
+    "retrieve_transaction_by_author": (
+        transaction.TRANSACTIONS_BY_AUTHOR,
+        (1, 0, 101),
+    ),
+    "retrieve_transaction_by_author by book": (
+        transaction.TRANSACTIONS_BY_AUTHOR_BOOK,
+        (1, 1, 0, 101),
+    ),
+    "retrieve_earnings": (transaction.EARNINGS, (1,)),
+    "retrieve_earnings by book": (transaction.BOOK_EARNINGS, (1, 1)),
+    "insert_reading": (reading.START_READING, (1, 1, 1, 1, date(2024, 1, 1))),
+    "book_completed": (reading.COMPLETE_BOOK, (1, 1, date(2024, 1, 1))),
+    "retrieve_reading": (reading.READINGS, (1, 0, 101)),
+    "retrieve_reading by book": (reading.BOOK_READINGS, (1, 1, 0, 101)),
+    "retrieve_reading_by_author": (reading.READINGS_BY_AUTHOR, (1, 0, 101)),
+    "retrieve_engagement": (
+        reading.ENGAGEMENT,
+        (datetime(2024, 1, 1).date(), 7, 1, 0, 101),
+    ),
+}
+
+# queries that need pg_trgm, checked where it is installed
+TRIGRAM_QUERIES = {
+    "search_books with trigrams": (
+        book.FUZZY_SEARCH_BOOKS,
+        QUERIES["search_books"][1],
+    ),
+}
+
+
+def available_migrations():
+    """
+    Returns (version, name, path) of every migration file, in order
+    """
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.fullmatch(r"(\d+)_(\w+)\.sql", filename)
+        if match:
+            version, name = int(match.group(1)), match.group(2)
+            migrations.append((version, name, os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+def applied_versions(cursor):
+    """
+    Returns the versions recorded in schema_migrations
+    """
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS public.schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT now()
+        )"""
+    )
+    cursor.execute("SELECT version FROM public.schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate():
+    """
+    Applies pending migrations, each in its own transaction
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_ID,))
+        try:
+            applied = applied_versions(cursor)
+            conn.commit()
+
+            for version, name, path in available_migrations():
+                if version in applied:
+                    continue
+
+                with open(path, encoding="utf-8") as migration:
+                    cursor.execute(migration.read())
+                cursor.execute(
+                    """INSERT INTO public.schema_migrations (version, name)
+                    VALUES (%s, %s)""",
+                    (version, name),
+                )
+                conn.commit()
+                print(f"applied {version:04d}_{name}")
+
+        finally:
+            conn.rollback()
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_ID,))
+            conn.commit()
+
+
+def status():
+    """
+    Prints every migration and whether it has been applied
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        applied = applied_versions(cursor)
+        conn.commit()
+
+    for version, name, _ in available_migrations():
+        state = "applied" if version in applied else "pending"
+        print(f"{version:04d}_{name}: {state}")
+
+
+def full_scans(plan):
+    """
+    Returns the tables read in full anywhere in plan, either by a sequential
+    scan or by an index scan without an index condition
+    """
+    tables = []
+    node_type = plan["Node Type"]
+    if node_type == "Seq Scan":
+        tables.append(plan["Relation Name"])
+
+    elif node_type in INDEX_SCANS and "Index Cond" not in plan:
+        tables.append(plan.get("Relation Name", plan.get("Index Name")))
+
+    for child in plan.get("Plans", []):
+        tables.extend(full_scans(child))
+    return tables
+
+
+def checked_queries(cursor):
+    """
+    Returns the queries run by the controllers, by name, with sample
+    parameters: the prepared statements, QUERIES and, if pg_trgm is
+    installed, TRIGRAM_QUERIES
+    """
+    queries = {}
+    for name, query in statements.STATEMENTS.items():
+        queries[name] = (query, STATEMENT_PARAMS.get(name))
+
+    queries.update(QUERIES)
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+    )
+    if cursor.fetchone()[0]:
+        queries.update(TRIGRAM_QUERIES)
+    return queries
+
+
+def check_indexes():
+    """
+    EXPLAINs every query of the controllers with sequential scans, hash and
+    merge joins disabled, so that the plan does not depend on how many rows
+    the tables hold. A full scan that remains means no index can serve the
+    query. Returns True if every query uses indexes.
+    """
+    passed = True
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for setting in PLANNER_SETTINGS:
+            cursor.execute(f"SET LOCAL {setting} = off")
+
+        for name, (query, params) in checked_queries(cursor).items():
+            if params is None:
+                passed = False
+                print(f"FAIL {name}: no sample parameters in STATEMENT_PARAMS")
+                continue
+
+            cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            tables = full_scans(plan[0]["Plan"])
+            if tables:
+                passed = False
+                print(f"FAIL {name}: full scan of {', '.join(tables)}")
+
+            else:
+                print(f"ok   {name}")
+
+        conn.rollback()
+
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("--status", action="store_true", help="list migrations")
+    parser.add_argument(
+        "--check", action="store_true", help="check that queries use indexes"
+    )
+    args = parser.parse_args()
+
+    if args.status:
+        status()
+
+    elif args.check:
+        sys.exit(0 if check_indexes() else 1)
+
+    else:
+        migrate()
+
+
+if __name__ == "__main__":
+    main()
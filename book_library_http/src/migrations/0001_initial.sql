@@ -0,0 +1,42 @@
+-- Tables used by the controllers
+CREATE TABLE IF NOT EXISTS public.user (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    password BYTEA NOT NULL,
+    bank_account TEXT,
+    upi_id TEXT,
+    is_active BOOLEAN NOT NULL DEFAULT TRUE,
+    is_admin BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS public.book (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    price NUMERIC(12, 2) NOT NULL,
+    author_id INTEGER REFERENCES public.user (id),
+    royalty NUMERIC(5, 2),
+    is_active BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+CREATE TABLE IF NOT EXISTS public.transactions (
+    user_id INTEGER NOT NULL REFERENCES public.user (id),
+    book_id INTEGER NOT NULL REFERENCES public.book (id),
+    amount NUMERIC(12, 2) NOT NULL,
+    time TIMESTAMP NOT NULL DEFAULT now(),
+    id SERIAL PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS public.reading (
+    book_id INTEGER NOT NULL REFERENCES public.book (id),
+    user_id INTEGER NOT NULL REFERENCES public.user (id),
+    id SERIAL PRIMARY KEY,
+    is_completed BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS public.user_token (
+    user_id INTEGER NOT NULL UNIQUE REFERENCES public.user (id),
+    token TEXT NOT NULL,
+    expiration_time TIMESTAMP NOT NULL
+);
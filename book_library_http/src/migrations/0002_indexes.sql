@@ -0,0 +1,29 @@
+-- Indexes behind the predicates the controllers filter and join on
+
+-- retrieve_transaction, retrieve_purchased, the user catalog in retrieve_book
+CREATE INDEX IF NOT EXISTS transactions_user_id_book_id_idx
+    ON public.transactions (user_id, book_id);
+
+-- retrieve_transaction_by_author joins transactions to the author's books
+CREATE INDEX IF NOT EXISTS transactions_book_id_idx
+    ON public.transactions (book_id);
+
+-- retrieve_reading, retrieve_purchased, insert_reading, book_completed
+CREATE INDEX IF NOT EXISTS reading_user_id_book_id_idx
+    ON public.reading (user_id, book_id);
+
+-- retrieve_reading_by_author joins reading to the author's books
+CREATE INDEX IF NOT EXISTS reading_book_id_idx
+    ON public.reading (book_id);
+
+-- retrieve_book_by_author and the author checks on book
+CREATE INDEX IF NOT EXISTS book_author_id_idx
+    ON public.book (author_id);
+
+-- authenticate and update_password only look at active accounts
+CREATE INDEX IF NOT EXISTS user_email_active_idx
+    ON public.user (email) WHERE is_active;
+
+-- validate_token
+CREATE INDEX IF NOT EXISTS user_token_token_expiration_time_idx
+    ON public.user_token (token, expiration_time);
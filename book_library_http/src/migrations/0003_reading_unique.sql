@@ -0,0 +1,23 @@
+-- A user reads a book at most once; insert_reading relies on this to start
+-- reading with a single upsert
+
+-- fold duplicate rows into the oldest one, keeping its completion
+UPDATE public.reading AS kept SET is_completed = TRUE
+WHERE NOT kept.is_completed AND EXISTS (
+    SELECT 1 FROM public.reading AS duplicate
+    WHERE duplicate.user_id = kept.user_id AND duplicate.book_id = kept.book_id
+    AND duplicate.is_completed
+);
+
+DELETE FROM public.reading AS duplicate USING public.reading AS kept
+WHERE duplicate.user_id = kept.user_id AND duplicate.book_id = kept.book_id
+AND duplicate.id > kept.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS reading_user_id_book_id_key
+    ON public.reading (user_id, book_id);
+
+ALTER TABLE public.reading ADD CONSTRAINT reading_user_id_book_id_key
+    UNIQUE USING INDEX reading_user_id_book_id_key;
+
+-- superseded by the unique index
+DROP INDEX IF EXISTS public.reading_user_id_book_id_idx;
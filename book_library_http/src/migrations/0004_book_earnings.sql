@@ -0,0 +1,28 @@
+-- Sales of every book per month, kept up to date by insert_transaction and
+-- insert_transactions in the statement that records the purchase, so that
+-- /earnings reads a few rows per author instead of every transaction.
+-- The royalty is the author's share at the time of the sale.
+CREATE TABLE IF NOT EXISTS public.book_earnings (
+    book_id INTEGER NOT NULL REFERENCES public.book (id),
+    period DATE NOT NULL,
+    author_id INTEGER REFERENCES public.user (id),
+    units INTEGER NOT NULL DEFAULT 0,
+    gross NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    royalty NUMERIC(16, 4) NOT NULL DEFAULT 0,
+    PRIMARY KEY (book_id, period)
+);
+
+-- retrieve_earnings
+CREATE INDEX IF NOT EXISTS book_earnings_author_id_period_idx
+    ON public.book_earnings (author_id, period);
+
+-- earlier sales, at the royalty the books have now
+INSERT INTO public.book_earnings (book_id, period, author_id, units, gross, royalty)
+SELECT transactions.book_id, date_trunc('month', transactions.time)::date,
+    book.author_id, count(*), sum(transactions.amount),
+    sum(transactions.amount * COALESCE(book.royalty, 0) / 100)
+FROM public.transactions
+JOIN public.book ON book.id = transactions.book_id
+GROUP BY transactions.book_id, date_trunc('month', transactions.time)::date,
+    book.author_id
+ON CONFLICT (book_id, period) DO NOTHING;
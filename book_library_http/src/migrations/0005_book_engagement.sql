@@ -0,0 +1,24 @@
+-- Readers of every book, counted by insert_reading and book_completed in the
+-- statement that changes reading, so that /engagement reads one row per
+-- book instead of every reader
+CREATE TABLE IF NOT EXISTS public.book_engagement (
+    book_id INTEGER PRIMARY KEY REFERENCES public.book (id),
+    started INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0
+);
+
+-- the same counts per day, for the recent velocity of a book
+CREATE TABLE IF NOT EXISTS public.book_engagement_daily (
+    book_id INTEGER NOT NULL REFERENCES public.book (id),
+    day DATE NOT NULL,
+    started INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (book_id, day)
+);
+
+-- readers so far; reading has no timestamps, so the daily counts start now
+INSERT INTO public.book_engagement (book_id, started, completed)
+SELECT book_id, count(*), count(*) FILTER (WHERE is_completed)
+FROM public.reading
+GROUP BY book_id
+ON CONFLICT (book_id) DO NOTHING;
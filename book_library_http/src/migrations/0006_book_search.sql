@@ -0,0 +1,24 @@
+-- Search over book names for /book/search: the words of every name as a
+-- tsvector, and trigrams of the name for misspelt and partial words.
+-- Adding the stored column rewrites book once.
+ALTER TABLE public.book ADD COLUMN IF NOT EXISTS search TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('english', name)) STORED;
+
+CREATE INDEX IF NOT EXISTS book_search_idx
+    ON public.book USING GIN (search);
+
+-- trigrams need pg_trgm; without it search matches whole words and prefixes
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS book_name_trgm_idx
+            ON public.book USING GIN (lower(name) gin_trgm_ops);
+    ELSE
+        RAISE NOTICE 'pg_trgm is not available, book search will not match trigrams';
+    END IF;
+
+EXCEPTION WHEN insufficient_privilege THEN
+    RAISE NOTICE 'pg_trgm cannot be created, book search will not match trigrams';
+END
+$$;
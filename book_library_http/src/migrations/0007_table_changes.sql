@@ -0,0 +1,31 @@
+-- Tells the servers listening on table_changed which table a statement
+-- changed, whichever process ran it, so that the table versions behind the
+-- ETags of conditional GETs also see provision_users.py, the dataset
+-- generator and manual changes. Notifications are sent on commit and the
+-- same table is notified once per transaction.
+CREATE OR REPLACE FUNCTION public.notify_table_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('table_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END
+$$;
+
+DO $$
+DECLARE
+    changed TEXT;
+BEGIN
+    FOREACH changed IN ARRAY ARRAY['user', 'book', 'transactions', 'reading'] LOOP
+        EXECUTE format(
+            'DROP TRIGGER IF EXISTS %I ON public.%I',
+            changed || '_changed', changed
+        );
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE '
+            'ON public.%I FOR EACH STATEMENT '
+            'EXECUTE FUNCTION public.notify_table_changed()',
+            changed || '_changed', changed
+        );
+    END LOOP;
+END
+$$;
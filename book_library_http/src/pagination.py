@@ -0,0 +1,68 @@
+"""
+Helpers for cursor based (keyset) pagination of list endpoints
+"""
+import base64
+import binascii
+import json
+
+from config import MAX_PAGE_SIZE, PAGE_SIZE
+
+# ids are INTEGER columns
+MAX_ID = 2**31 - 1
+
+
+def encode_cursor(value):
+    """
+    Returns an opaque cursor pointing after value
+    """
+    raw = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the value encoded in cursor, raising ValueError if it is invalid
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        return json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+
+    except (binascii.Error, UnicodeError, ValueError) as err:
+        raise ValueError("Invalid cursor") from err
+
+
+def is_id(value):
+    """Returns whether value, decoded from a cursor, is a valid row id"""
+    # bool is an int, but is sent to the database as a boolean
+    return type(value) is int and 0 <= value <= MAX_ID
+
+
+def page_bounds(limit=None, after=None):
+    """
+    Validates the page size and cursor of a request. Returns the limit and
+    the id to continue after, raising ValueError for invalid input.
+    """
+    if limit is None:
+        limit = PAGE_SIZE
+
+    if not isinstance(limit, int) or not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    after_id = 0
+    if after is not None:
+        if not isinstance(after, str):
+            raise ValueError("Invalid cursor")
+
+        after_id = decode_cursor(after)
+        if not is_id(after_id):
+            raise ValueError("Invalid cursor")
+
+    return limit, after_id
+
+
+def split_page(rows, limit):
+    """
+    Splits the limit + 1 rows fetched for a page into the page itself and
+    whether another page follows
+    """
+    return rows[:limit], len(rows) > limit
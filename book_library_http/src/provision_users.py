@@ -0,0 +1,163 @@
+"""
+Provisions user accounts in bulk from a CSV file whose first line holds the
+columns name, email, password and optionally account_num and upi_id.
+
+    python provision_users.py readers.csv
+    python provision_users.py - < readers.csv
+
+Passwords are hashed on every core and each batch is copied into the user
+table in its own transaction, so an interrupted run can simply be repeated:
+emails that are already registered are reported and skipped.
+"""
+import argparse
+import csv
+import io
+import sys
+import time
+from itertools import islice
+
+from config import PROVISION_BATCH_SIZE, get_connection
+from controllers.user import validate_user
+from hashing import hash_many
+
+COLUMNS = ("name", "email", "password", "account_num", "upi_id")
+
+CREATE_STAGING = """CREATE TEMPORARY TABLE user_staging (
+    line INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    password BYTEA NOT NULL,
+    bank_account TEXT,
+    upi_id TEXT
+) ON COMMIT DELETE ROWS"""
+
+COPY_STAGING = """COPY user_staging (line, name, email, password, bank_account,
+    upi_id) FROM STDIN WITH (FORMAT csv)"""
+
+# skips emails registered since the batch was checked, e.g. by /signup
+INSERT_USERS = """WITH inserted AS (
+    INSERT INTO public.user (name, email, password, bank_account, upi_id)
+    SELECT name, email, password, bank_account, upi_id FROM user_staging
+    WHERE NOT EXISTS (
+        SELECT 1 FROM public.user
+        WHERE public.user.email = user_staging.email AND public.user.is_active
+    )
+    RETURNING email
+)
+SELECT line, email FROM user_staging
+WHERE email NOT IN (SELECT email FROM inserted)"""
+
+
+def read_users(rows, seen, report):
+    """
+    Returns the valid users of rows as (line, fields) and reports invalid
+    ones and emails already seen earlier in the file
+    """
+    users = []
+    for line, row in rows:
+        fields = [row.get(column) or None for column in COLUMNS]
+        error = validate_user(*fields)
+        if error:
+            report(line, error)
+
+        elif fields[1] in seen:
+            report(line, f"duplicate email {fields[1]} (line {seen[fields[1]]})")
+
+        else:
+            seen[fields[1]] = line
+            users.append((line, fields))
+    return users
+
+
+def registered(cursor, users):
+    """Returns the emails of users that already have an active account"""
+    cursor.execute(
+        "SELECT email FROM public.user WHERE is_active AND email = ANY(%s)",
+        ([fields[1] for _, fields in users],),
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def copy_users(cursor, users, hashes):
+    """Copies users and their password hashes into user_staging"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for (line, fields), hashed in zip(users, hashes):
+        name, email, _, account_num, upi_id = fields
+        writer.writerow((line, name, email, "\\x" + hashed.hex(), account_num, upi_id))
+    buffer.seek(0)
+    cursor.copy_expert(COPY_STAGING, buffer)
+
+
+def provision(source, batch_size):
+    """
+    Provisions the users read from source. Returns the numbers of users
+    created and rejected.
+    """
+    created = rejected = 0
+
+    def report(line, error):
+        nonlocal rejected
+        rejected += 1
+        print(f"line {line}: {error}", file=sys.stderr)
+
+    reader = csv.DictReader(source)
+    rows = ((reader.line_num, row) for row in reader)
+    seen = {}
+    start = time.perf_counter()
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CREATE_STAGING)
+        conn.commit()
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            users = read_users(batch, seen, report)
+            existing = registered(cursor, users) if users else set()
+            for line, fields in users:
+                if fields[1] in existing:
+                    report(line, f"email {fields[1]} is already registered")
+            users = [user for user in users if user[1][1] not in existing]
+
+            if users:
+                hashes = hash_many([fields[2] for _, fields in users])
+                copy_users(cursor, users, hashes)
+                cursor.execute(INSERT_USERS)
+                for line, email in cursor.fetchall():
+                    report(line, f"email {email} is already registered")
+                created += len(users) - cursor.rowcount
+            conn.commit()
+
+            elapsed = time.perf_counter() - start
+            print(f"{created} users created, {created / elapsed:.0f} users/s")
+
+    return created, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("file", help="CSV file of users, or - for stdin")
+    parser.add_argument("--batch-size", type=int, default=PROVISION_BATCH_SIZE)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.file == "-":
+        created, rejected = provision(sys.stdin, args.batch_size)
+
+    else:
+        with open(args.file, newline="", encoding="utf-8") as source:
+            created, rejected = provision(source, args.batch_size)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"done: {created} created, {rejected} rejected in {elapsed:.1f}s "
+        f"({created / elapsed:.0f} users/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Routes requests to their handlers by method and path, and composes the
+middleware that runs around every handler.
+
+    router = Router()
+
+    @router.route("GET", "/book/{book_id:int}", roles=("user",))
+    def get_book(request, book_id):
+        ...
+
+A path segment in braces is a parameter, passed to the handler by name and
+converted by its type: int or str, the default. Fixed segments take
+precedence over parameters. Routes are compiled into a tree of segments at
+startup, so matching a path costs one lookup per segment however many routes
+there are.
+"""
+import http
+from functools import partial
+
+import metrics
+from encoder import encode_json
+
+
+def _integer(segment):
+    # int() also takes signs, spaces and non ascii digits
+    if not (segment.isascii() and segment.isdigit()):
+        raise ValueError(segment)
+    return int(segment)
+
+
+CONVERTERS = {"int": _integer, "str": str}
+
+
+class NotFound(Exception):
+    """No route matches the path"""
+
+
+class MethodNotAllowed(Exception):
+    """Routes match the path, but none for the method"""
+
+    def __init__(self, allowed):
+        super().__init__(", ".join(allowed))
+        self.allowed = allowed
+
+
+class Response:
+    """
+    Status, headers and encoded body of a response, handed back through the
+    middleware before it is written
+    """
+
+    __slots__ = ("status", "body", "content_type", "headers")
+
+    def __init__(self, status, body=b"", content_type=None, headers=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, status, payload, headers=None):
+        """Returns a response with payload encoded as JSON"""
+        with metrics.phase("serialize"):
+            body = encode_json(payload)
+        return cls(status, body, "application/json", headers)
+
+    @classmethod
+    def error(cls, status, message=None, headers=None):
+        """Returns an error in REST format"""
+        if not message:
+            message = http.HTTPStatus(status).phrase
+        return cls.json(
+            status, {"error": {"code": status, "message": message}}, headers
+        )
+
+
+class Route:
+    """
+    A method and path pattern, with the handler of every role allowed to
+    use it. The handler of a public route is kept under the role None.
+    """
+
+    def __init__(self, method, pattern, tables=(), daily=False):
+        self.method = method
+        self.pattern = pattern
+        # tables the route reads, whose versions make up its ETag
+        self.tables = tables
+        # whether the response also depends on the date, which is then part
+        # of the ETag too
+        self.daily = daily
+        self.handlers = {}
+
+    @property
+    def public(self):
+        return None in self.handlers
+
+
+class _Node:
+    # one path segment of the routing tree
+    __slots__ = ("children", "parameter", "converter", "child", "routes")
+
+    def __init__(self):
+        self.children = {}
+        self.parameter = None
+        self.converter = None
+        self.child = None
+        self.routes = {}
+
+
+class Router:
+    """
+    Maps method and path to a Route. A path may have a handler per role, so
+    that users and admins share a route but not its behaviour.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self.routes = []
+
+    def add(self, method, pattern, handler, *, roles=None, tables=(), daily=False):
+        """
+        Adds handler for method and pattern, for each of roles or for
+        everyone, without authentication, if roles is None
+        """
+        node = self._root
+        for segment in pattern.strip("/").split("/"):
+            if not (segment.startswith("{") and segment.endswith("}")):
+                node = node.children.setdefault(segment, _Node())
+                continue
+
+            name, _, kind = segment[1:-1].partition(":")
+            converter = CONVERTERS[kind or "str"]
+            if node.child is None:
+                node.child = _Node()
+                node.parameter, node.converter = name, converter
+
+            elif (node.parameter, node.converter) != (name, converter):
+                raise ValueError(f"{pattern} conflicts with {{{node.parameter}}}")
+            node = node.child
+
+        route = node.routes.get(method)
+        if route is None:
+            route = node.routes[method] = Route(method, pattern, tables, daily)
+            self.routes.append(route)
+
+        for role in roles or (None,):
+            if role in route.handlers:
+                raise ValueError(f"{method} {pattern} already has a {role} handler")
+            route.handlers[role] = handler
+        if route.public and len(route.handlers) > 1:
+            raise ValueError(f"{method} {pattern} cannot be public and guarded")
+
+    def route(self, method, pattern, *, roles=None, tables=(), daily=False):
+        """Decorator form of add"""
+
+        def decorator(handler):
+            self.add(method, pattern, handler, roles=roles, tables=tables, daily=daily)
+            return handler
+
+        return decorator
+
+    def match(self, method, path):
+        """
+        Returns the route of method and path and the converted parameters.
+        Raises NotFound or MethodNotAllowed.
+        """
+        node = self._root
+        params = {}
+        for segment in path.strip("/").split("/"):
+            child = node.children.get(segment)
+            if child is None:
+                if node.child is None:
+                    raise NotFound(path)
+                try:
+                    params[node.parameter] = node.converter(segment)
+
+                except ValueError:
+                    raise NotFound(path) from None
+                child = node.child
+            node = child
+
+        route = node.routes.get(method)
+        if route is None:
+            if not node.routes:
+                raise NotFound(path)
+            raise MethodNotAllowed(sorted(node.routes))
+        return route, params
+
+
+def chain(middleware, endpoint):
+    """
+    Returns endpoint wrapped in middleware, the first being outermost. A
+    middleware is called as middleware(request, call_next) and returns the
+    Response, usually the one returned by call_next(request).
+    """
+    handler = endpoint
+    for layer in reversed(middleware):
+        handler = partial(layer, call_next=handler)
+    return handler
@@ -0,0 +1,73 @@
+"""
+Registry of the hot controller queries as named, server side prepared
+statements. Each statement is prepared the first time it is used on a
+pooled connection and then executed by name, so Postgres parses and plans
+it once per connection instead of once per request.
+"""
+from psycopg2 import errors
+
+STATEMENTS = {
+    "validate_token": """SELECT user_id, is_admin, expiration_time
+        FROM public.user, public.user_token
+        WHERE public.user_token.user_id = public.user.id
+        AND public.user.is_active = True
+        AND public.user_token.token = %s
+        AND public.user_token.expiration_time > %s""",
+    "authenticate": """SELECT password,id FROM public.user
+        WHERE is_active=True AND email = %s""",
+    "book_by_id": """SELECT id,name,author_id,price FROM public.book WHERE id=%s""",
+    "transactions_by_user": """SELECT user_id, book_id, amount, time, id
+        FROM public.transactions
+        WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s""",
+    "transactions_by_user_book": """SELECT user_id, book_id, amount, time, id
+        FROM public.transactions WHERE user_id = %s AND book_id = %s AND id > %s ORDER BY id LIMIT %s""",
+}
+
+
+def _numbered(query):
+    # PREPARE takes $1, $2, ... where psycopg2 takes %s
+    parts = query.split("%s")
+    return parts[0] + "".join(
+        f"${number}{part}" for number, part in enumerate(parts[1:], start=1)
+    )
+
+
+def prepare(cursor, name):
+    """
+    Prepares the statement name on the connection of cursor
+    """
+    cursor.execute(f"PREPARE {name} AS {_numbered(STATEMENTS[name])}")
+    cursor.connection.prepared.add(name)
+
+
+def execute(cursor, name, params=()):
+    """
+    Executes the statement name with params on cursor, preparing it first if
+    the connection has not seen it yet. Connections created outside the pool
+    simply run the query. If the server no longer knows the statement, as
+    after a DISCARD ALL, it is prepared again; in a transaction that has
+    already failed the error is raised instead.
+    """
+    conn = cursor.connection
+    prepared = getattr(conn, "prepared", None)
+    if prepared is None:
+        cursor.execute(STATEMENTS[name], params)
+        return
+
+    if name not in prepared:
+        prepare(cursor, name)
+
+    query = f"EXECUTE {name}"
+    if params:
+        query += f" ({', '.join(['%s'] * len(params))})"
+
+    try:
+        cursor.execute(query, params)
+
+    except errors.InvalidSqlStatementName:
+        prepared.discard(name)
+        if not conn.autocommit:
+            raise
+
+        prepare(cursor, name)
+        cursor.execute(query, params)